@@ -0,0 +1,109 @@
+from collections import OrderedDict
+import gzip
+import hashlib
+import json
+import os
+import shutil
+import threading
+import zlib
+
+
+class AudioCache:
+    """
+    Persistent, content-addressed store of synthesized sentences.
+    Files are keyed by a hash of the sentence text and the voice settings, so audio is reused
+    whatever page the sentence lands on. The total size is capped by evicting the least
+    recently played files. With compress set, files are stored gzipped and unpacked when played.
+    """
+    def __init__(self, directory: str, max_bytes: int = 200 * 1024 * 1024, compress: bool = False) -> None:
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.compress = compress
+        self.lock = threading.Lock()
+        self.entries: OrderedDict[str, tuple[str, int]] = OrderedDict()  # key -> (path, size), oldest first
+        self.size = 0
+        os.makedirs(directory, exist_ok=True)
+        self._scan()
+
+    def _scan(self) -> None:
+        found = []
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                if not (name.endswith('.wav') or name.endswith('.wav.gz')):
+                    continue
+                path = os.path.join(root, name)
+                stat = os.stat(path)
+                found.append((stat.st_mtime, name.split('.')[0], path, stat.st_size))
+        for _, key, path, size in sorted(found):
+            self.entries[key] = (path, size)
+            self.size += size
+
+    @staticmethod
+    def key(text: str, voice: dict) -> str:
+        return hashlib.sha1(json.dumps([text, voice], sort_keys=True).encode('utf-8')).hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key[:2], key + ('.wav.gz' if self.compress else '.wav'))
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.entries
+
+    def lookup(self, key: str, scratch_path: str) -> str | None:
+        # returns a playable wav file, unpacking compressed entries to scratch_path
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            self.entries.move_to_end(key)
+        path = entry[0]
+        try:
+            os.utime(path)  # modification time is the recency order after a restart
+            if not path.endswith('.gz'):
+                return path
+            os.makedirs(os.path.dirname(scratch_path), exist_ok=True)
+            with gzip.open(path, 'rb') as src, open(scratch_path, 'wb') as dst:
+                shutil.copyfileobj(src, dst)
+            return scratch_path
+        except (OSError, EOFError, zlib.error) as e:
+            # missing, truncated or corrupt, so the entry is dropped and synthesized again
+            print(f"Error reading cached audio {path}: {e}")
+            with self.lock:
+                if self.entries.get(key) == entry:
+                    del self.entries[key]
+                    self.size -= entry[1]
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            return None
+
+    def store(self, key: str, wav_path: str) -> None:
+        # moves a freshly synthesized wav file into the cache
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if self.compress:
+            # written to a temporary file first, so a crash never leaves a truncated entry for _scan to find
+            tmp_path = path + '.tmp'
+            with open(wav_path, 'rb') as src, gzip.open(tmp_path, 'wb', compresslevel=6) as dst:
+                shutil.copyfileobj(src, dst)
+            os.replace(tmp_path, path)
+            os.remove(wav_path)
+        else:
+            shutil.move(wav_path, path)
+        size = os.path.getsize(path)
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= old[1]
+            self.entries[key] = (path, size)
+            self.size += size
+            self._evict()
+
+    def _evict(self) -> None:
+        while self.size > self.max_bytes and len(self.entries) > 1:
+            _, (path, size) = self.entries.popitem(last=False)
+            self.size -= size
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
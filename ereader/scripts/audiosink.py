@@ -0,0 +1,234 @@
+from abc import ABC, abstractmethod
+from collections import deque
+import subprocess
+import threading
+import time
+import wave
+from typing import Callable
+
+
+class AudioSink(ABC):
+    """Destination for raw PCM audio. configure is called before the first write and whenever the format changes."""
+    realtime = True  # whether writes are heard as they happen, so the writer has to pace them
+
+    def configure(self, rate: int, channels: int, sample_width: int) -> None:
+        self.format = (rate, channels, sample_width)
+
+    @abstractmethod
+    def write(self, data: bytes) -> None:
+        pass
+
+    def reset(self) -> None:
+        # drop audio that was written but has not been heard yet
+        pass
+
+    def close(self) -> None:
+        pass
+
+
+class AplaySink(AudioSink):
+    """Plays through one long-lived aplay process reading raw PCM from stdin."""
+    def __init__(self, buffer_time_us: int = 100000) -> None:
+        self.buffer_time_us = buffer_time_us
+        self.format: tuple[int, int, int] | None = None
+        self.proc: subprocess.Popen | None = None
+
+    def configure(self, rate: int, channels: int, sample_width: int) -> None:
+        if (rate, channels, sample_width) != self.format:
+            self.reset()
+            self.format = (rate, channels, sample_width)
+
+    def write(self, data: bytes) -> None:
+        if self.proc is None or self.proc.poll() is not None:
+            rate, channels, sample_width = self.format
+            self.proc = subprocess.Popen(['aplay', '-q', '-t', 'raw', '-f', {1: 'U8', 2: 'S16_LE', 4: 'S32_LE'}[sample_width],
+                                          '-r', str(rate), '-c', str(channels), f'--buffer-time={self.buffer_time_us}', '-'],
+                                         stdin=subprocess.PIPE)
+        try:
+            self.proc.stdin.write(data)
+            self.proc.stdin.flush()
+        except BrokenPipeError:
+            self.proc = None
+
+    def reset(self) -> None:
+        # aplay cannot drop its buffer, so restart it on the next write
+        if self.proc is not None:
+            self.proc.kill()
+            self.proc.wait()
+            self.proc = None
+
+    def close(self) -> None:
+        if self.proc is not None:
+            self.proc.stdin.close()
+            self.proc.wait()
+            self.proc = None
+
+
+class NullSink(AudioSink):
+    """Discards audio, counting what was written. For running and testing without a sound card."""
+    realtime = False
+
+    def __init__(self) -> None:
+        self.format = None
+        self.bytes_written = 0
+        self.resets = 0
+
+    def write(self, data: bytes) -> None:
+        self.bytes_written += len(data)
+
+    def reset(self) -> None:
+        self.resets += 1
+
+
+class WavFileSink(AudioSink):
+    """Writes everything played into one wav file, e.g. to check that sentences follow each other without gaps."""
+    realtime = False
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.format = None
+        self.file: wave.Wave_write | None = None
+
+    def configure(self, rate: int, channels: int, sample_width: int) -> None:
+        if self.file is None:
+            self.file = wave.open(self.path, 'wb')
+            self.file.setframerate(rate)
+            self.file.setnchannels(channels)
+            self.file.setsampwidth(sample_width)
+            self.format = (rate, channels, sample_width)
+        elif (rate, channels, sample_width) != self.format:
+            raise ValueError(f"{self.path} is {self.format}, cannot append {(rate, channels, sample_width)} audio")
+
+    def write(self, data: bytes) -> None:
+        self.file.writeframes(data)
+
+    def close(self) -> None:
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+def read_wav(path: str) -> tuple[tuple[int, int, int], bytes] | None:
+    try:
+        with wave.open(path, 'rb') as file:
+            return (file.getframerate(), file.getnchannels(), file.getsampwidth()), file.readframes(file.getnframes())
+    except (OSError, EOFError, wave.Error) as e:
+        print(f"Error reading audio {path}: {e}")
+        return None
+
+
+class AudioOutput:
+    """
+    Plays queued sentences back to back through one sink from a single writer thread.
+    Items are loaded only when their turn comes, so a sentence can be queued before it is synthesized.
+    Writes are paced to stay at most max_ahead seconds ahead of real time, which keeps pause,
+    stop and the reported current item close to what is actually heard.
+    """
+    def __init__(self, sink: AudioSink, on_start: Callable[[object], None] | None = None,
+                 on_idle: Callable[[], None] | None = None, chunk_seconds: float = 0.05, max_ahead: float = 0.2) -> None:
+        self.sink = sink
+        self.on_start = on_start  # called from the writer thread with the tag of each item as it starts
+        self.on_idle = on_idle  # called from the writer thread when the last queued item has finished
+        self.chunk_seconds = chunk_seconds
+        self.max_ahead = max_ahead
+        self.gain = 1.0
+        self.paused = False
+        self.items: deque[tuple[object, Callable[[], tuple[tuple[int, int, int], bytes] | None]]] = deque()
+        self.current: object | None = None
+        self.generation = 0  # bumped by flush, so the writer abandons whatever it was playing
+        self.cond = threading.Condition()
+        self.clock_start = time.monotonic()
+        self.written = 0.0  # seconds of audio written since clock_start
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def enqueue(self, tag: object, load: Callable[[], tuple[tuple[int, int, int], bytes] | None]) -> None:
+        # load returns ((rate, channels, sample_width), pcm), or None to skip the item
+        with self.cond:
+            self.items.append((tag, load))
+            self.cond.notify_all()
+
+    def flush(self) -> None:
+        with self.cond:
+            self.items.clear()
+            self.generation += 1
+            self.current = None
+            self.paused = False
+            self.cond.notify_all()
+
+    def set_paused(self, paused: bool) -> None:
+        with self.cond:
+            self.paused = paused
+            self.cond.notify_all()
+
+    def is_busy(self) -> bool:
+        # True while an item is playing or paused, or more are queued
+        with self.cond:
+            return self.current is not None or bool(self.items)
+
+    def _scale(self, chunk: bytes, sample_width: int) -> bytes:
+        if self.gain == 1.0 or sample_width != 2:
+            return chunk
+        # imported here since it is only needed once the volume is changed, and it is slow to import on the Pi
+        import numpy as np
+        samples = np.frombuffer(chunk, dtype='<i2') * self.gain
+        return np.clip(samples, -32768, 32767).astype('<i2').tobytes()
+
+    def _run(self) -> None:
+        while True:
+            with self.cond:
+                while not self.items:
+                    self.cond.wait()
+                tag, load = self.items.popleft()
+                generation = self.generation
+                self.current = tag
+            try:
+                self._play(tag, load, generation)
+            except Exception as e:
+                # the item is skipped (e.g. a corrupt cache file or aplay failing to start), the thread keeps going
+                print(f"Error playing {tag}: {e}")
+            with self.cond:
+                if generation != self.generation:
+                    continue
+                self.current = None
+                idle = not self.items
+            if idle and self.on_idle is not None:
+                self.on_idle()
+
+    def _play(self, tag: object, load: Callable[[], tuple[tuple[int, int, int], bytes] | None], generation: int) -> None:
+        loaded = load()
+        if loaded is None or generation != self.generation:
+            return
+        (rate, channels, sample_width), pcm = loaded
+        if self.on_start is not None:
+            self.on_start(tag)
+        self.sink.configure(rate, channels, sample_width)
+        frame_bytes = channels * sample_width
+        chunk_bytes = max(frame_bytes, int(rate * self.chunk_seconds) * frame_bytes)
+        for offset in range(0, len(pcm), chunk_bytes):
+            with self.cond:
+                while self.paused and generation == self.generation:
+                    self.cond.wait()
+                if generation != self.generation:
+                    break
+            chunk = pcm[offset:offset + chunk_bytes]
+            if self.sink.realtime:
+                self._pace()
+            self.sink.write(self._scale(chunk, sample_width))
+            self.written += len(chunk) / (rate * frame_bytes)
+        if generation != self.generation:
+            # flushed: drop what the sink still buffers so playback stops right away
+            self.sink.reset()
+            return
+        if not self.items and self.sink.realtime:
+            # nothing follows, so wait until the end of this item has actually been heard
+            time.sleep(max(0.0, self.written - (time.monotonic() - self.clock_start)))
+
+    def _pace(self) -> None:
+        ahead = self.written - (time.monotonic() - self.clock_start)
+        if ahead < 0:
+            # the sink ran dry (start, pause or a slow load), so restart the clock from now
+            self.clock_start = time.monotonic()
+            self.written = 0.0
+        elif ahead > self.max_ahead:
+            time.sleep(ahead - self.max_ahead)
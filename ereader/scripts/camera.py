@@ -1,8 +1,11 @@
 from picamera2 import Picamera2, Preview
 from libcamera import controls
+import os
 import time
 from PIL import Image
 
+from imagefile import ImageFile
+
     
 class DocumentCamera:
     def __init__(self, directory: str, num_pages:  int = 0) -> None:
@@ -14,22 +17,27 @@ class DocumentCamera:
         self.camera.set_controls({"AfMode": controls.AfModeEnum.Continuous})
         self.camera.start_preview(Preview.QTGL)
         self.camera.start()
+        self.capture_config = self.camera.create_still_configuration()
         self.directory = directory
-        self.images = []
+        os.makedirs(directory, exist_ok=True)
+        # frames are saved as they are taken, only their handles stay in memory
+        self.images: list[ImageFile] = []
 
-    def capture_image(self) -> str:
-        self.capture_config = self.camera.create_still_configuration()
+    def capture_image(self) -> ImageFile:
         array = self.camera.switch_mode_and_capture_array(self.capture_config, "main")
-        img = Image.fromarray(array)
-        self.images.append(img)
-        img.show()
+        # the fourth channel of the camera's XBGR frames is padding, not transparency
+        img = Image.fromarray(array).convert("RGB")
+        image_file = ImageFile.save(img, f'{self.directory}/page_{len(self.images) + 1:03}.png')
+        self.images.append(image_file)
+        return image_file
         
-    def retake_image(self) -> str:
+    def retake_image(self) -> ImageFile:
+        # replaces the last image, which is then self.images[-1]
         if len(self.images) > 0:
             self.images = self.images[:-1]
-        self.capture_image()
+        return self.capture_image()
         
-    def done_capturing(self):
+    def done_capturing(self) -> list[ImageFile]:
         self.camera.close()
         return self.images
                 
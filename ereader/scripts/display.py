@@ -1,14 +1,24 @@
+from array import array
+import os
 from typing import Iterable, Sequence
-from PIL import Image, ImageDraw, ImageFont
-from waveshare_epd import epd4in26
-import math
+from PIL import Image, ImageChops, ImageDraw, ImageFont
+import functools
 
+from measure import TextMeasurer
+from panel import PanelDriver, make_driver
 
-class Page:
+# lines estimated within this many pixels of the page width are measured exactly (non-basic layout only)
+LINE_SLACK = 2
+# canvas diffing for partial refreshes: rows are compared in bands of this height, and more than
+# MAX_REGIONS changed regions or more than FULL_REFRESH_RATIO of the screen falls back to sending the full frame
+DIFF_BAND_HEIGHT = 16
+MAX_REGIONS = 4
+FULL_REFRESH_RATIO = 0.5
+
+
+class PageStyle:
+    """Page geometry and font shared by every page of a document, and the scratch drawing that measures text."""
     def __init__(self, width: int, height: int, font: ImageFont, line_space: int) -> None:
-        # tuple is (start_x, start_y, string)
-        self.sentence_segments: list[list[tuple[int, int, str]]] = []
-        self.sentences: list[str] = []
         self.width = width
         self.height = height
         self.font = font
@@ -17,77 +27,211 @@ class Page:
         self.max_lines = self.height // (self.line_height + self.line_space)
         if self.height % (self.line_height + self.line_space) >= (self.line_height + descent):
             self.max_lines += 1
-        self.lines = ['']
-        self.image = Image.new("1", (self.width, self.height), 255)
-        self.image_drawn = False
-        self.draw = ImageDraw.Draw(self.image)
+        # only used for measuring, pages are rendered onto fresh images by page_image
+        self.draw = ImageDraw.Draw(Image.new("1", (1, 1), 255))
         self.draw.font = self.font
+        self.measurer = TextMeasurer.for_font(self.font, self.draw.fontmode)
+
+
+class Page:
+    """
+    Laid out page: character spans of its lines, sentences and highlight segments in the document text,
+    packed into arrays. Strings and the bitmap are made from the text only when the page is shown or spoken.
+    """
+    __slots__ = ('style', 'text', 'line_spans', 'sentence_spans', 'segment_spans', 'segment_boxes', 'segment_starts')
+
+    def __init__(self, style: PageStyle, text: Sequence[str], line_spans: array, sentence_spans: array,
+                 segment_spans: array, segment_boxes: array, segment_starts: array) -> None:
+        self.style = style
+        self.text = text  # str or TextFile, anything that can be sliced by character offsets
+        self.line_spans = line_spans  # start, end of each line
+        self.sentence_spans = sentence_spans  # start, end of each (part of a) sentence on the page
+        self.segment_spans = segment_spans  # start, end of each segment, a sentence's part of a line
+        self.segment_boxes = segment_boxes  # x, y, width of each segment
+        self.segment_starts = segment_starts  # index of each sentence's first segment, and the total at the end
+
+    @property
+    def start(self) -> int:
+        # offset of the first character on the page
+        return self.line_spans[0]
+
+    @property
+    def lines(self) -> list[str]:
+        # the text shows the newlines between sentences on a line as spaces
+        spans = self.line_spans
+        return [self.text[spans[i]:spans[i + 1]].replace('\n', ' ') for i in range(0, len(spans), 2)]
+
+    @property
+    def sentences(self) -> list[str]:
+        spans = self.sentence_spans
+        return [self.text[spans[i]:spans[i + 1]] for i in range(0, len(spans), 2)]
 
     def page_image(self) -> Image:
-        self.image_drawn = True
+        style = self.style
+        image = Image.new("1", (style.width, style.height), 255)
+        draw = ImageDraw.Draw(image)
+        draw.font = style.font
         for i, line in enumerate(self.lines):
-            self.draw.text((0, i * (self.line_height + self.line_space)), line)
-        return self.image
+            draw.text((0, i * (style.line_height + style.line_space)), line)
+        return image
 
-    def draw_highlight_sentences(self, sentences: Sequence[int]) -> Image:
-        if not self.image_drawn:
-            self.page_image()
-        segments = []
-        for sentence in sentences:
-            segments.extend(self.sentence_segments[sentence])
-        print(segments)
-        ascent, descent = self.font.getmetrics()
+    def highlight_boxes(self, sentence: int) -> list[tuple[int, int, int, int]]:
+        # boxes covering the text of a sentence on the rendered page, from the widths measured at layout
+        if sentence < 0 or sentence >= len(self.segment_starts) - 1:
+            return []
+        style = self.style
+        ascent, descent = style.font.getmetrics()
         box_height = ascent + descent
-        highlighted_image = self.image.copy()
-        draw = ImageDraw.Draw(highlighted_image)
-        draw.font = self.font
-        for item in segments:
-            draw.rectangle((item[0], item[1], item[0] + draw.textlength(item[2]), item[1] + box_height), fill=0)
-            draw.text((item[0], item[1]), item[2], fill=255)
-        return highlighted_image
+        boxes = self.segment_boxes
+        return [(int(boxes[i]), int(boxes[i + 1]), min(int(boxes[i] + boxes[i + 2]) + 1, style.width),
+                 min(int(boxes[i + 1]) + box_height + 1, style.height))
+                for i in range(3 * self.segment_starts[sentence], 3 * self.segment_starts[sentence + 1], 3)]
+
+    def to_record(self) -> dict:
+        segments = [[[self.segment_boxes[3 * i], self.segment_boxes[3 * i + 1], self.segment_spans[2 * i],
+                      self.segment_spans[2 * i + 1], self.segment_boxes[3 * i + 2]]
+                     for i in range(self.segment_starts[sentence], self.segment_starts[sentence + 1])]
+                    for sentence in range(len(self.segment_starts) - 1)]
+        return {"lines": [list(self.line_spans[i:i + 2]) for i in range(0, len(self.line_spans), 2)],
+                "sentences": [list(self.sentence_spans[i:i + 2]) for i in range(0, len(self.sentence_spans), 2)],
+                "segments": segments}
+
+    @staticmethod
+    def from_record(style: PageStyle, record: dict, text: Sequence[str]) -> 'Page':
+        # rebuilds a page stored by to_record without measuring any text
+        segments = [segment for sentence in record["segments"] for segment in sentence]
+        starts = [0]
+        for sentence in record["segments"]:
+            starts.append(starts[-1] + len(sentence))
+        return Page(style, text, array('I', [offset for span in record["lines"] for offset in span]),
+                    array('I', [offset for span in record["sentences"] for offset in span]),
+                    array('I', [offset for _, _, start, end, _ in segments for offset in (start, end)]),
+                    array('f', [value for x, y, _, _, width in segments for value in (x, y, width)]),
+                    array('H', starts))
+
+    @staticmethod
+    def generate_pages(width: int, height: int, font: ImageFont, line_space: int, sentences: Iterable[str]
+                       ) -> list['Page']:
+        style = PageStyle(width, height, font, line_space)
+        sentences = list(sentences)
+        text = '\n'.join(sentences)
+        builder = PageBuilder(style)
+        pages = []
+        offset = 0
+        for sent in sentences:
+            remainder = builder.add_sentence(sent, offset)
+            while remainder:
+                pages.append(builder.page(text))
+                builder = PageBuilder(style)
+                remainder = builder.add_sentence(remainder, offset + len(sent) - len(remainder))
+            offset += len(sent) + 1
+        pages.append(builder.page(text))
+        return pages
 
 
-    def add_sentence(self, sentence: str) -> str | None:
+class PageBuilder:
+    """Fills one page with sentences, measuring them, then packs the result into a Page."""
+    def __init__(self, style: PageStyle) -> None:
+        self.style = style
+        self.lines = ['']
+        self.line_length = 0.0  # measured length of the last line
+        # character spans in the document text of lines, sentences and segments, and the segments' boxes
+        self.line_spans: list[list[int]] = [[0, 0]]
+        self.sentence_spans: list[list[int]] = []
+        self.segment_spans: list[list[tuple[int, int]]] = []
+        self.segment_boxes: list[list[tuple[float, int, float]]] = []  # (start_x, start_y, width)
+
+    def add_sentence(self, sentence: str, offset: int = 0) -> str | None:
+        # offset is the position of the sentence in the document text
         # todo make it split words larger than width? currently just breaks
-        start_x = self.draw.textlength(self.sentence_segments[-1][-1][2] + ' ') if self.sentence_segments else 0
+        style = self.style
+        measurer = style.measurer
+        start_x = measurer.extend_line(self.lines[-1][-1], self.line_length, '') if self.lines[-1] else 0
         segment_start_word = 0
         words = sentence.split(' ')
+        word_starts = []
+        for word in words:
+            word_starts.append(offset)
+            offset += len(word) + 1
         for i, word in enumerate(words):
             if not self.lines[-1]:
                 new_line = word
+                line_start = word_starts[i]
+                line_length = measurer.length(word)
             else:
                 new_line = self.lines[-1] + ' ' + word
-            line_length = self.draw.textlength(new_line)
-            if line_length > self.width or i == len(words) - 1:
-                added_words = ' '.join(words[segment_start_word:i if i < len(words) - 1 else i + 1])
+                line_start = self.line_spans[-1][0]
+                line_length = measurer.extend_line(self.lines[-1][-1], self.line_length, word)
+            if not measurer.exact and line_length > style.width - LINE_SLACK:
+                # shaping engines can kern across words, so measure lines near the limit in full
+                line_length = style.draw.textlength(new_line)
+            if line_length > style.width or i == len(words) - 1:
+                segment_words = words[segment_start_word:i if i < len(words) - 1 else i + 1]
+                added_words = ' '.join(segment_words)
                 if added_words:
                     if segment_start_word == 0:
-                        self.sentence_segments.append([])
-                    start_y = (len(self.lines) - 1) * (self.line_height + self.line_space)
-                    self.sentence_segments[-1].append((start_x, start_y, added_words))
-            if line_length > self.width:
-                if len(self.lines) == self.max_lines:
+                        self.segment_boxes.append([])
+                        self.segment_spans.append([])
+                    start_y = (len(self.lines) - 1) * (style.line_height + style.line_space)
+                    self.segment_boxes[-1].append((start_x, start_y, measurer.join_length(segment_words)))
+                    segment_start = word_starts[segment_start_word]
+                    self.segment_spans[-1].append((segment_start, segment_start + len(added_words)))
+            if line_length > style.width:
+                if len(self.lines) == style.max_lines:
                     added_words = ' '.join(words[:i])
                     if added_words:
-                        self.sentences.append(added_words)
+                        self.sentence_spans.append([word_starts[0], word_starts[0] + len(added_words)])
                     return ' '.join(words[i:])
                 segment_start_word = i
                 self.lines.append(word)
+                self.line_spans.append([word_starts[i], word_starts[i] + len(word)])
+                self.line_length = measurer.length(word)
                 start_x = 0
             else:
                 self.lines[-1] = new_line
-        self.sentences.append(sentence)
+                self.line_length = line_length
+                self.line_spans[-1] = [line_start, word_starts[i] + len(word)]
+        self.sentence_spans.append([word_starts[0], word_starts[0] + len(sentence)])
 
-    @staticmethod
-    def generate_pages(width: int, height: int, font: ImageFont, line_space: int, sentences: Iterable[str]
-                       ) -> list['Page']:
-        pages = [Page(width, height, font, line_space)]
-        for sent in sentences:
-            remainder = pages[-1].add_sentence(sent)
-            while remainder:
-                pages.append(Page(width, height, font, line_space))
-                remainder = pages[-1].add_sentence(remainder)
-        return pages
+    def page(self, text: Sequence[str]) -> Page:
+        # text is what the offsets given to add_sentence refer to
+        starts = [0]
+        for boxes in self.segment_boxes:
+            starts.append(starts[-1] + len(boxes))
+        return Page(self.style, text, array('I', [offset for span in self.line_spans for offset in span]),
+                    array('I', [offset for span in self.sentence_spans for offset in span]),
+                    array('I', [offset for spans in self.segment_spans for span in spans for offset in span]),
+                    array('f', [value for boxes in self.segment_boxes for box in boxes for value in box]),
+                    array('H', starts))
+
+
+class HighlightedPage:
+    """
+    A rendered page with a movable sentence highlight. Moving the highlight inverts only the boxes of
+    the sentences that change, which turns black text on white into white text on black and back.
+    """
+    def __init__(self, page: Page, image: Image) -> None:
+        self.page = page
+        self.image = image.copy()  # the page cache's image is shared, so highlight a private copy
+        self.sentences: set[int] = set()
+
+    def highlight(self, sentences: Sequence[int]) -> tuple[int, int, int, int] | None:
+        # returns the bounding box of the pixels that changed, or None if nothing did
+        sentences = set(sentences)
+        changed = None
+        for sentence in self.sentences ^ sentences:
+            for box in self.page.highlight_boxes(sentence):
+                self.image.paste(ImageChops.invert(self.image.crop(box)), box[:2])
+                changed = box if changed is None else (min(changed[0], box[0]), min(changed[1], box[1]),
+                                                       max(changed[2], box[2]), max(changed[3], box[3]))
+        self.sentences = sentences
+        return changed
+
+
+@functools.cache
+def default_font(size: int) -> ImageFont.FreeTypeFont:
+    # loading the built in font decodes it every time, so UI code shares one instance per size
+    return ImageFont.load_default(size)
 
 
 class Menu:
@@ -95,34 +239,53 @@ class Menu:
         self.items = items
         self.width = width
         self.height =  height
-        self.font = ImageFont.load_default(40)
-        self.images = []
+        self.font = default_font(40)
         self.margins = margins
         ascent, _ = self.font.getmetrics()
         self.box_height = ascent + 2 * margins[1]
         self.items_per_page = self.height // self.box_height
-        num_pages = math.ceil(len(items) / self.items_per_page)
-        self.images = [Image.new("1", (self.width, self.height), 255) for i in range(num_pages)]
-        for i, image in enumerate(self.images):
-            draw = ImageDraw.Draw(image)
-            draw.font = self.font
-            for j in range(self.items_per_page):
-                item_num = i * self.items_per_page + j
-                if item_num == len(self.items):
-                    break
-                draw.rectangle((0, j * self.box_height, self.width, (j + 1) * self.box_height), outline=0)
-                draw.text((margins[0], int((j + 0.5) * self.box_height)), self.items[item_num], fill="black", anchor="lm")
+        # only the visible page is rendered, from rows cached in their normal and selected variants
+        self.rows: dict[tuple[int, bool], Image.Image] = {}
+        self.image = Image.new("1", (self.width, self.height), 255)
+        self.image_page: int | None = None
+        self.image_selected = 0
         self.selected = 0
 
+    def _row_image(self, item_num: int, selected: bool) -> Image:
+        row = self.rows.get((item_num, selected))
+        if row is None:
+            # one pixel taller than the box so the bottom border matches the next row's top border
+            row = Image.new("1", (self.width, self.box_height + 1), 255)
+            draw = ImageDraw.Draw(row)
+            draw.font = self.font
+            if selected:
+                draw.rectangle((0, 0, self.width, self.box_height), fill=0, outline=0)
+            else:
+                draw.rectangle((0, 0, self.width, self.box_height), outline=0)
+            draw.text((self.margins[0], int(0.5 * self.box_height)), self.items[item_num],
+                      fill="white" if selected else "black", anchor="lm")
+            self.rows[(item_num, selected)] = row
+        return row
+
+    def _paste_row(self, item_num: int, selected: bool) -> None:
+        index = item_num % self.items_per_page
+        self.image.paste(self._row_image(item_num, selected), (0, index * self.box_height))
+
     def menu_image(self) -> Image:
-        image_num = self.selected // self.items_per_page
-        image = self.images[image_num].copy()
-        index = self.selected % self.items_per_page
-        draw = ImageDraw.Draw(image)
-        draw.font = self.font
-        draw.rectangle((0, index * self.box_height, self.width, (index + 1) * self.box_height), fill=0, outline=0)
-        draw.text((self.margins[0], int((index + 0.5) * self.box_height)), self.items[image_num * self.items_per_page + index], fill="white", anchor="lm")
-        return image
+        # the returned image is reused and updated in place by later calls
+        page = self.selected // self.items_per_page
+        if page != self.image_page:
+            self.rows.clear()
+            self.image.paste(255, (0, 0, self.width, self.height))
+            first = page * self.items_per_page
+            for item_num in range(first, min(first + self.items_per_page, len(self.items))):
+                self._paste_row(item_num, item_num == self.selected)
+            self.image_page = page
+        elif self.selected != self.image_selected:
+            self._paste_row(self.image_selected, False)
+            self._paste_row(self.selected, True)
+        self.image_selected = self.selected
+        return self.image
 
     def go_item(self, index: int) -> int:
         if index >= len(self.items) or index < 0:
@@ -138,18 +301,88 @@ class Menu:
 
 
 
+def changed_regions(old: Image, new: Image) -> list[tuple[int, int, int, int]]:
+    """Boxes (x0, y0, x1, y1) covering every pixel that differs between two mode "1" images.
+    x0 and x1 are rounded out to whole bytes of the panel buffer."""
+    diff = ImageChops.logical_xor(old, new)
+    bbox = diff.getbbox()
+    if bbox is None:
+        return []
+    regions = []
+    for top in range(bbox[1], bbox[3], DIFF_BAND_HEIGHT):
+        band_box = diff.crop((bbox[0], top, bbox[2], min(top + DIFF_BAND_HEIGHT, bbox[3]))).getbbox()
+        if band_box is None:
+            continue
+        box = [bbox[0] + band_box[0], top + band_box[1], bbox[0] + band_box[2], top + band_box[3]]
+        if regions and regions[-1][3] >= top - DIFF_BAND_HEIGHT:
+            # changes in neighbouring bands are refreshed as one window
+            last = regions[-1]
+            regions[-1] = [min(last[0], box[0]), last[1], max(last[2], box[2]), box[3]]
+        else:
+            regions.append(box)
+    if len(regions) > MAX_REGIONS:
+        regions = [list(bbox)]
+    return [(x0 // 8 * 8, y0, min(-(-x1 // 8) * 8, new.width), y1) for x0, y0, x1, y1 in regions]
+
+
 class Display:
-    def __init__(self, button_height: int) -> None:
+    def __init__(self, button_height: int, driver: PanelDriver | None = None, boot_frame: str | None = None) -> None:
         self.button_height = button_height
-        self.epd = epd4in26.EPD()
-        self.epd.init()
-        self.epd.Clear()
-        self.width = self.epd.width
-        self.height = self.epd.height
-        self.canvas = Image.new("1", (self.epd.width, self.epd.height))
+        self.driver = driver if driver is not None else make_driver()
+        self.driver.init()
+        self.width = self.driver.width
+        self.height = self.driver.height
+        self.canvas = Image.new("1", (self.width, self.height))
+        self.last_frame: Image.Image | None = None  # what the panel is showing, None forces a full frame
+        self.button_bars: dict[tuple[str, ...], Image.Image] = {}  # rendered button bars by labels
+        # a frame saved by save_boot_frame is shown instead of clearing the panel, so there is something
+        # to look at while the rest of the app starts, and an unchanged first screen needs no refresh at all
+        self.boot_frame = boot_frame
+        splash = self._load_boot_frame()
+        if splash is None:
+            self.driver.clear()
+        else:
+            self.driver.show_frame(splash)
+            self.canvas = splash
+            self.last_frame = splash.copy()
+
+    def _load_boot_frame(self) -> Image.Image | None:
+        if self.boot_frame is None or not os.path.exists(self.boot_frame):
+            return None
+        try:
+            with Image.open(self.boot_frame) as image:
+                if image.size != (self.width, self.height):
+                    return None
+                return image.convert("1")
+        except OSError as e:
+            print(f"Error loading boot frame: {e}")
+            return None
+
+    def save_boot_frame(self) -> None:
+        # keeps what the panel shows now for the next start, unless that is what is saved already
+        if self.boot_frame is None or self.last_frame is None:
+            return
+        splash = self._load_boot_frame()
+        if splash is not None and splash.tobytes() == self.last_frame.tobytes():
+            return
+        os.makedirs(os.path.dirname(self.boot_frame) or '.', exist_ok=True)
+        tmp_path = self.boot_frame + '.tmp'
+        self.last_frame.save(tmp_path, format="PNG")
+        os.replace(tmp_path, self.boot_frame)
 
     def paint_canvas(self) -> None:
-        self.epd.display_Partial(self.epd.getbuffer(self.canvas))
+        regions = changed_regions(self.last_frame, self.canvas) if self.last_frame is not None else None
+        if regions == []:
+            return
+        if regions is None or not self.driver.supports_regions or \
+                sum((x1 - x0) * (y1 - y0) for x0, y0, x1, y1 in regions) > FULL_REFRESH_RATIO * self.width * self.height:
+            self.driver.show_frame(self.canvas)
+        else:
+            self.driver.show_regions(self.canvas, regions)
+        if self.last_frame is None:
+            self.last_frame = self.canvas.copy()
+        else:
+            self.last_frame.paste(self.canvas)
 
     def draw_screen(self, image: Image, margins=(0, 0)) -> None:
         self.canvas.paste(image, margins)
@@ -157,12 +390,14 @@ class Display:
     def draw_button_labels(self, labels: list[str]) -> None:
         if not self.button_height > 0:
             return
-        buttons = Image.new("1", (self.epd.width, self.button_height), color="white")
-        draw = ImageDraw.Draw(buttons)
-        draw.font = ImageFont.load_default(20)
-        button_width = self.epd.width / len(labels)
-        for i, label in enumerate(labels):
-            draw.rectangle((button_width * i, 0, button_width * (i + 1), buttons.height), outline=0)
-            draw.text((button_width * (2 * i + 1) / 2, buttons.height / 2), label, fill="black", anchor="mm")
+        buttons = self.button_bars.get(tuple(labels))
+        if buttons is None:
+            buttons = Image.new("1", (self.width, self.button_height), color="white")
+            draw = ImageDraw.Draw(buttons)
+            draw.font = default_font(20)
+            button_width = self.width / len(labels)
+            for i, label in enumerate(labels):
+                draw.rectangle((button_width * i, 0, button_width * (i + 1), buttons.height), outline=0)
+                draw.text((button_width * (2 * i + 1) / 2, buttons.height / 2), label, fill="black", anchor="mm")
+            self.button_bars[tuple(labels)] = buttons
         self.canvas.paste(buttons, (0, self.height - self.button_height))
-
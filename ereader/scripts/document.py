@@ -1,19 +1,243 @@
+import bisect
+import os
+import threading
+from typing import Callable
 from PIL import ImageFont
 
-from display import Page
+from display import Page, PageBuilder, PageStyle
+from fontmanager import font_key
+from layoutindex import LayoutIndex
+from textfile import TextFile
+
+
+class _Layout:
+    """Pages laid out one after another from offset start of the text, and where the page after them begins."""
+    def __init__(self, doc: 'Document', start: int = 0) -> None:
+        self.pages: list[Page] = []
+        self.start = start
+        self.complete = False
+        # index of the next sentence that has not been given to a page
+        self.next_sentence = doc.text.sentence_at(start) if start > 0 else 0
+        self.remainder: str | None = None  # part of a sentence that overflowed the last page
+        self.remainder_offset = 0
+        if start > 0 and start != doc.text.start(self.next_sentence):
+            # starting inside a sentence, the first page begins with the rest of it
+            self.remainder_offset = start
+            self.remainder = doc.text[start:doc.text.end(self.next_sentence)]
+            self.next_sentence += 1
+        self.consumed_chars = doc.text.start(self.next_sentence)
+
+    def next_offset(self, doc: 'Document') -> int:
+        # where the page after the last one laid out starts
+        return self.remainder_offset if self.remainder else doc.text.start(self.next_sentence)
+
+    def laid_out_chars(self) -> int:
+        return self.consumed_chars - len(self.remainder or '') - self.start
+
 
 class Document:
-    def __init__(self, path: str, width: int, height: int, font: ImageFont, line_space: int) -> None:
-        with open(path, 'r') as file:
-            self.sentences: list[str] = file.read().splitlines()
-        self.pages: list[Page] = Page.generate_pages(width, height, font, line_space, self.sentences)
-        self.current_page = 1  # read from metadata if not 1
-        self.id = 0 # numerical designation of document
+    def __init__(self, path: str, width: int, height: int, font: ImageFont, line_space: int, id: int = 0,
+                 position: int = 0, page_hint: int = 1, on_settled: Callable[[], None] | None = None) -> None:
+        # sentences joined by single newlines, read from disk as needed; page layouts refer to character spans of it
+        self.text = TextFile(path)
+        self.width = width
+        self.height = height
+        self.font = font
+        self.line_space = line_space
+        self.style = PageStyle(width, height, font, line_space)
+        # pages are laid out lazily, so this only holds the pages built so far (see page_count)
+        self._layout = _Layout(self)
+        self.pages: list[Page] = self._layout.pages
+        self.lock = threading.RLock()  # pages are also laid out from the page cache's prefetch thread
+        # opened at a position the pages before it are not known yet, so layout starts at the position in
+        # _anchored, numbered from anchor_page, while the exact pages are laid out in the background (see settle)
+        self._anchored: _Layout | None = None
+        self.anchor_page = 1
+        self._stop_layout = threading.Event()
+        self._anchor_reached = threading.Event()  # the background layout is up to the opening position
+        self.on_settled = on_settled  # called from layout_in_background's thread once settle() has nothing left to do
+        self.current_page = 1
+        self.id = id # numerical designation of document, its library id
+        self.layout_index = LayoutIndex(os.path.dirname(path))
+        self.layout_key = LayoutIndex.make_key(self.text.hash, font_key(font), line_space,
+                                               width, height)
+        self._load_layout()
+        self._saved_pages = len(self.pages)
+        if position > 0:
+            self._open_at(position, page_hint)
+        else:
+            self._layout_until(1)
+
+    @property
+    def layout_complete(self) -> bool:
+        return self._layout.complete
+
+    def _load_layout(self) -> None:
+        entry = self.layout_index.load(self.layout_key)
+        if entry is None:
+            return
+        layout = self._layout
+        layout.pages[:] = [Page.from_record(self.style, record, self.text) for record in entry["pages"]]
+        layout.complete = entry["complete"]
+        layout.next_sentence = entry["next_sentence"]
+        layout.consumed_chars = self.text.start(layout.next_sentence)
+        if entry["remainder_offset"] is not None:
+            layout.remainder_offset = entry["remainder_offset"]
+            layout.remainder = self.text[layout.remainder_offset:self.text.end(layout.next_sentence - 1)]
+
+    def save_layout(self) -> None:
+        # stores the exact pages laid out so far, so reopening with the same settings can skip measuring them
+        with self.lock:
+            if len(self.pages) == self._saved_pages:
+                return
+            layout = self._layout
+            self.layout_index.save(self.layout_key, {
+                "pages": [page.to_record() for page in self.pages],
+                "complete": layout.complete,
+                "next_sentence": layout.next_sentence,
+                "remainder_offset": layout.remainder_offset if layout.remainder else None,
+            })
+            self._saved_pages = len(self.pages)
+
+    def _layout_page(self, layout: _Layout) -> None:
+        builder = PageBuilder(self.style)
+        remainder = layout.remainder
+        if remainder:
+            remainder = builder.add_sentence(remainder, layout.remainder_offset)
+        while not remainder and layout.next_sentence < self.text.count:
+            sentence = self.text.sentence(layout.next_sentence)
+            offset = self.text.start(layout.next_sentence)
+            layout.next_sentence += 1
+            layout.consumed_chars += len(sentence) + 1
+            remainder = builder.add_sentence(sentence, offset)
+        if remainder:
+            layout.remainder_offset = self.text.end(layout.next_sentence - 1) - len(remainder)
+        layout.remainder = remainder
+        layout.pages.append(builder.page(self.text))
+        if not remainder and layout.next_sentence == self.text.count:
+            layout.complete = True
+
+    def _layout_until(self, num: int) -> bool:
+        with self.lock:
+            layout, count = self._layout, num
+            if self._anchored is not None:
+                if num < self.anchor_page:
+                    return False  # not known until settled
+                layout, count = self._anchored, num - self.anchor_page + 1
+            while len(layout.pages) < count and not layout.complete:
+                self._layout_page(layout)
+            return len(layout.pages) >= count
+
+    def _layout_past(self, offset: int) -> None:
+        # exact pages until one of them contains offset
+        with self.lock:
+            while not self._layout.complete and self._layout.next_offset(self) <= offset:
+                self._layout_page(self._layout)
+
+    def _open_at(self, position: int, page_hint: int) -> None:
+        # starts at the page containing position: straight away if the saved layout reaches it, otherwise
+        # layout starts right at position and gets numbered from page_hint until the exact layout catches up
+        position = min(position, max(0, self.text.total_chars - 2))
+        with self.lock:
+            if self._layout.complete or self._layout.next_offset(self) > position:
+                self.current_page = max(1, bisect.bisect_right([page.start for page in self.pages], position))
+                return
+            self._anchored = _Layout(self, position)
+            self.anchor_page = max(page_hint, len(self.pages) + 1)
+            self.current_page = self.anchor_page
+            self._layout_until(self.current_page)
+
+    def layout_in_background(self) -> None:
+        # lays out the exact pages before the opening position on a thread, so settle() has nothing left to do;
+        # started by the reader once the first page is up, since it competes with rendering for the interpreter
+        if self._anchored is not None:
+            threading.Thread(target=self._layout_to_anchor, args=(self._anchored.start,), daemon=True).start()
+
+    def _layout_to_anchor(self, anchor: int) -> None:
+        # one page per lock, so page turns and prefetching never wait for more than a page
+        while not self._stop_layout.is_set():
+            with self.lock:
+                if self._layout.complete or self._layout.next_offset(self) > anchor:
+                    break
+                self._layout_page(self._layout)
+        else:
+            return
+        self._anchor_reached.set()
+        if self.on_settled is not None:
+            self.on_settled()
+
+    def settle(self) -> bool:
+        """
+        Swaps the pages laid out from the opening position for the exact layout from the start, finishing that
+        layout first if the background has not yet. If the position was an exact page start (the usual case,
+        it was saved with the same settings) the pages stay and only their numbers change, otherwise the
+        current page becomes the exact page containing the start of the current one.
+        Returns True if page numbers changed, so anything keyed by them (cached images) is stale.
+        """
+        with self.lock:
+            anchored = self._anchored
+            if anchored is None:
+                return False
+            self._layout_past(anchored.start)
+            layout = self._layout
+            current_start = anchored.pages[self.current_page - self.anchor_page].start
+            index = len(self.pages) - 1
+            if index >= 0 and self.pages[index].start == anchored.start:
+                # the anchored pages are exact as well, so they continue the exact ones
+                self.pages[index:] = anchored.pages
+                layout.next_sentence = anchored.next_sentence
+                layout.remainder = anchored.remainder
+                layout.remainder_offset = anchored.remainder_offset
+                layout.consumed_chars = anchored.consumed_chars
+                layout.complete = anchored.complete
+                self.current_page += index + 1 - self.anchor_page
+            else:
+                self._layout_past(current_start)
+                self.current_page = max(1, bisect.bisect_right([page.start for page in self.pages],
+                                                               current_start))
+            self._anchored = None
+            self.anchor_page = 1
+            return True
+
+    def stop_layout(self) -> None:
+        # ends background layout, e.g. when the document is closed
+        self._stop_layout.set()
+
+    def position(self) -> int:
+        # offset in the text of the current page's first character, to open the document at next time
+        return self.get_current_page().start
+
+    def settle_ready(self) -> bool:
+        # whether settle() has a change to make that costs no more than the last background page
+        return self._anchored is not None and self._anchor_reached.is_set()
+
+    def first_page(self) -> int:
+        # lowest page number that can be shown before settling
+        return self.anchor_page if self._anchored is not None else 1
+
+    def page_count(self) -> int:
+        # exact once layout is complete, otherwise extrapolated from the text laid out so far
+        layout, before = self._layout, 0
+        if self._anchored is not None:
+            layout, before = self._anchored, self.anchor_page - 1
+        if layout.complete:
+            return before + len(layout.pages)
+        laid_out = layout.laid_out_chars()
+        if laid_out <= 0:
+            return before + len(layout.pages)
+        return before + max(len(layout.pages) + 1,
+                            round(len(layout.pages) * (self.text.total_chars - layout.start) / laid_out))
+
+    def has_page(self, num: int) -> bool:
+        return num >= 1 and self._layout_until(num)
 
     def get_page(self, num: int) -> Page:
-        if num < 1 or num > len(self.pages):
-            raise ValueError(f'Page {num} is out of range')
-        return self.pages[num - 1]
+        with self.lock:
+            if num < 1 or not self._layout_until(num):
+                raise ValueError(f'Page {num} is out of range')
+            if self._anchored is not None:
+                return self._anchored.pages[num - self.anchor_page]
+            return self.pages[num - 1]
 
     def get_current_page(self) -> Page:
         return self.get_page(self.current_page)
@@ -24,14 +248,30 @@ class Document:
     def get_prev_page(self) -> Page:
         return self.get_page(self.current_page - 1)
 
+    def last_page(self) -> int:
+        # highest page number laid out so far
+        if self._anchored is not None:
+            return self.anchor_page + len(self._anchored.pages) - 1
+        return len(self.pages)
+
+    def go_to_page(self, num: int) -> Page | None:
+        # moves to page num, or as close to it as the document goes; None if that is the current page
+        num = max(self.first_page(), num)
+        if not self._layout_until(num):
+            num = self.last_page()
+        if num == self.current_page:
+            return None
+        self.current_page = num
+        return self.get_page(num)
+
     def next_page(self) -> Page | None:
-        if self.current_page == len(self.pages):
+        if not self._layout_until(self.current_page + 1):
             return None
         self.current_page += 1
         return self.get_page(self.current_page)
 
     def prev_page(self) -> Page | None:
-        if self.current_page == 1:
+        if self.current_page == self.first_page():
             return None
         self.current_page -= 1
         return self.get_page(self.current_page)
@@ -0,0 +1,92 @@
+from collections import deque
+from enum import Enum
+import threading
+import time
+from typing import Callable
+
+
+class EventType(Enum):
+    BUTTON = 1  # data: ButtonPress
+    SENTENCE_STARTED = 2  # data: (dirname, sentence number)
+    PLAYBACK_FINISHED = 3  # data: None, nothing is left to play
+    SYNTH_DONE = 4  # data: audio cache key of the synthesized sentence
+    RENDER_DONE = 5  # data: page number rendered in the background
+    TASK_DONE = 6  # data: (name, result) of work run with run_in_background
+    TASK_PROGRESS = 7  # data: (name, done, total) reported by background work
+    LAYOUT_SETTLED = 8  # data: None, the exact page numbers of the open document are known (Document.settle)
+
+
+_now = time.monotonic
+
+
+class Event:
+    def __init__(self, type: EventType, data: object = None, time: float | None = None) -> None:
+        self.type = type
+        self.data = data
+        self.time = time  # monotonic time it happened, e.g. when a button's bytes arrived
+
+    def __repr__(self) -> str:
+        return f'Event({self.type.name}, {self.data!r})'
+
+
+class EventLoop:
+    """
+    Single queue that button presses, playback, synthesis and rendering all post to from their own threads.
+    Screens are handlers run with run(); they are called once per event, nothing polls, and the thread
+    sleeps in the queue until something happens. A handler calls stop(result) to return from run(),
+    and handlers can run nested ones (a menu opened from another screen), like modal dialogs.
+    """
+    def __init__(self) -> None:
+        self.events: deque[Event] = deque()
+        self.cond = threading.Condition()
+        self._running: list[list] = []  # [stopped, result] for each nested run
+
+    def post(self, type: EventType, data: object = None, time: float | None = None) -> None:
+        # safe to call from any thread; time defaults to now
+        with self.cond:
+            self.events.append(Event(type, data, time if time is not None else _now()))
+            self.cond.notify()
+
+    def poster(self, type: EventType) -> Callable[..., None]:
+        # callback for components that report through a function, e.g. on_done=loop.poster(EventType.SYNTH_DONE)
+        return lambda data=None, time=None: self.post(type, data, time)
+
+    def run(self, handler: Callable[[Event], None]) -> object:
+        state = [False, None]
+        self._running.append(state)
+        try:
+            while not state[0]:
+                handler(self._next())
+            return state[1]
+        finally:
+            self._running.pop()
+
+    def _next(self) -> Event:
+        with self.cond:
+            while not self.events:
+                self.cond.wait()
+            return self.events.popleft()
+
+    def take_while(self, predicate: Callable[[Event], bool]) -> list[Event]:
+        # removes and returns the events at the front of the queue that satisfy predicate, so a handler can
+        # fold a burst of them (e.g. five queued page turns) into one action
+        taken = []
+        with self.cond:
+            while self.events and predicate(self.events[0]):
+                taken.append(self.events.popleft())
+        return taken
+
+    def stop(self, result: object = None) -> None:
+        # ends the innermost run, which returns result
+        self._running[-1][:] = [True, result]
+
+    def run_in_background(self, name: str, work: Callable[[], object]) -> None:
+        # runs work on a thread and posts TASK_DONE with (name, result) when it returns
+        def target() -> None:
+            try:
+                result = work()
+            except Exception as e:
+                print(f"Error in {name}: {e}")
+                result = None
+            self.post(EventType.TASK_DONE, (name, result))
+        threading.Thread(target=target, daemon=True).start()
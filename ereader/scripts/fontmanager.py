@@ -11,6 +11,13 @@ from PIL import ImageFont, ImageDraw, Image
 class FontNotAvailableError(Exception):
     pass
 
+def font_key(font: ImageFont.FreeTypeFont | ImageFont.ImageFont) -> str:
+    """Identify a loaded font by family, file, size and layout engine, independent of where the fonts live."""
+    path = getattr(font, "path", None)
+    name = " ".join(font.getname()) if hasattr(font, "getname") else "bitmap"
+    file_name = os.path.basename(path) if isinstance(path, str) else "builtin"
+    return f"{name}:{file_name}:{getattr(font, 'size', 0)}:{getattr(font, 'layout_engine', '')}"
+
 class FontCollection:
     """A class to manage a collection of fonts."""
     def __init__(self, collection_path=None):
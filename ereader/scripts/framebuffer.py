@@ -0,0 +1,39 @@
+from PIL import Image
+
+
+class FrameBuffer:
+    """
+    Packs mode "1" images into the e-paper panel's buffer layout: one bit per pixel, rows of
+    (width + 7) // 8 bytes, most significant bit first, 1 for white. This is the layout Pillow's
+    raw "1" encoder already produces, so packing runs in C instead of per pixel in Python.
+    The same output buffer is reused for every frame.
+    """
+    def __init__(self, width: int, height: int) -> None:
+        self.width = width
+        self.height = height
+        self.row_bytes = (width + 7) // 8
+        self.buffer = bytearray(self.row_bytes * height)
+        self.view = memoryview(self.buffer)
+
+    def _orient(self, image: Image) -> Image:
+        if image.mode != "1":
+            image = image.convert("1")
+        if image.size == (self.width, self.height):
+            return image
+        if image.size == (self.height, self.width):
+            # portrait images are rotated like the Waveshare getbuffer does
+            return image.transpose(Image.Transpose.ROTATE_90)
+        raise ValueError(f"Image size {image.size} does not match the panel size {(self.width, self.height)}")
+
+    def pack(self, image: Image) -> bytearray:
+        self.view[:] = self._orient(image).tobytes("raw", "1")
+        return self.buffer
+
+    def pack_region(self, image: Image, box: tuple[int, int, int, int]) -> memoryview:
+        # box is (x0, y0, x1, y1) in panel coordinates, x0 must start a byte of the buffer
+        x0, y0, x1, y1 = box
+        if x0 % 8:
+            raise ValueError(f"Region must start on a byte boundary, got x0={x0}")
+        data = self._orient(image).crop(box).tobytes("raw", "1")
+        self.view[:len(data)] = data
+        return self.view[:len(data)]
@@ -0,0 +1,34 @@
+import os
+from PIL import Image
+
+
+class ImageFile:
+    """
+    Handle to an image saved on disk, loaded only when needed. It pickles as just the path,
+    so it can be sent to OCR worker processes that load the pixels themselves.
+    """
+    def __init__(self, path: str) -> None:
+        self.path = path
+
+    @staticmethod
+    def save(image: Image, path: str, compress_level: int = 1) -> 'ImageFile':
+        # PNG is lossless; level 1 compresses camera frames well at a fraction of the default's cost.
+        # Written to a temporary file first, so a reader never sees a half written image
+        tmp_path = path + '.tmp'
+        image.save(tmp_path, format="PNG", compress_level=compress_level)
+        os.replace(tmp_path, path)
+        return ImageFile(path)
+
+    def load(self) -> Image:
+        with Image.open(self.path) as image:
+            image.load()
+            return image
+
+    def remove(self) -> None:
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+    def __repr__(self) -> str:
+        return f'ImageFile({self.path!r})'
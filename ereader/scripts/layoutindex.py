@@ -0,0 +1,42 @@
+import json
+import os
+
+
+class LayoutIndex:
+    """
+    Disk-backed pagination results for one document, stored next to its text.txt.
+    Entries are keyed by the text hash, font, line spacing and page geometry, so a changed
+    text file or a different font profile never matches an old entry.
+    """
+    VERSION = 2
+
+    def __init__(self, directory: str, filename: str = "layout.json") -> None:
+        self.path = os.path.join(directory, filename)
+
+    @staticmethod
+    def make_key(text_hash: str, font_key: str, line_space: int, width: int, height: int) -> str:
+        return f"{text_hash}|{font_key}|{line_space}|{width}x{height}"
+
+    def _read(self) -> dict:
+        try:
+            with open(self.path, "r") as file:
+                data = json.load(file)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return {}
+        if not isinstance(data, dict) or data.get("version") != self.VERSION:
+            return {}
+        return data.get("entries", {})
+
+    def load(self, key: str) -> dict | None:
+        return self._read().get(key)
+
+    def save(self, key: str, entry: dict) -> None:
+        text_hash = key.split("|", 1)[0]
+        # entries for an older version of the text can never match again
+        entries = {k: v for k, v in self._read().items() if k.startswith(text_hash + "|")}
+        entries[key] = entry
+        # write to a temporary file first so a crash never leaves a truncated index behind
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as file:
+            json.dump({"version": self.VERSION, "entries": entries}, file)
+        os.replace(tmp_path, self.path)
@@ -0,0 +1,114 @@
+import json
+import os
+import shutil
+import sqlite3
+import time
+
+
+COLUMNS = ("name", "last_opened", "text_bytes", "page_count", "layout_complete", "current_page",
+           "position", "pending")
+# columns added since the table was first created, with their definitions, for databases made before them
+ADDED_COLUMNS = {"position": "INTEGER NOT NULL DEFAULT 0", "pending": "INTEGER NOT NULL DEFAULT 0"}
+
+
+class Library:
+    """
+    Index of the documents in the library directory, kept in SQLite so ids are stable, lookups go by
+    primary key and every update is an atomic, crash safe transaction. Each document's files live in
+    <directory>/doc_<id>. A library that still only has the old .metadata.json list is imported on first open.
+    """
+    def __init__(self, directory: str = 'library') -> None:
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.db = sqlite3.connect(os.path.join(directory, 'library.db'))
+        self.db.row_factory = sqlite3.Row
+        self.db.execute('PRAGMA journal_mode=WAL')
+        with self.db:
+            self.db.execute('''CREATE TABLE IF NOT EXISTS documents (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,  -- never reused, ids name directories
+                name TEXT NOT NULL,
+                added REAL NOT NULL,
+                last_opened REAL,
+                text_bytes INTEGER,
+                page_count INTEGER,
+                layout_complete INTEGER NOT NULL DEFAULT 0,
+                current_page INTEGER NOT NULL DEFAULT 1,
+                position INTEGER NOT NULL DEFAULT 0,  -- text offset of the current page's first character
+                pending INTEGER NOT NULL DEFAULT 0  -- 1 from add() until its text is written, hidden meanwhile
+            )''')
+            columns = [row["name"] for row in self.db.execute('PRAGMA table_info(documents)')]
+            for column, definition in ADDED_COLUMNS.items():
+                if column not in columns:
+                    self.db.execute(f'ALTER TABLE documents ADD COLUMN {column} {definition}')
+        self._remove_pending()
+        self._import_metadata()
+
+    def _import_metadata(self) -> None:
+        path = os.path.join(self.directory, '.metadata.json')
+        if self.db.execute('SELECT 1 FROM documents LIMIT 1').fetchone() is not None or not os.path.exists(path):
+            return
+        try:
+            with open(path, 'r') as file:
+                names = json.load(file)
+        except (OSError, ValueError) as e:
+            print(f"Error importing library metadata: {e}")
+            return
+        if not isinstance(names, list):
+            print("Library metadata is not a json list")
+            return
+        # the old list's index was the doc_N directory number, which becomes the id
+        with self.db:
+            for i, name in enumerate(names):
+                text_path = os.path.join(self.doc_dir(i), 'text.txt')
+                text_bytes = os.path.getsize(text_path) if os.path.exists(text_path) else None
+                self.db.execute('INSERT INTO documents (id, name, added, text_bytes) VALUES (?, ?, ?, ?)',
+                                (i, str(name), time.time(), text_bytes))
+
+    def _remove_pending(self) -> None:
+        # documents whose capture never finished, e.g. the power went during OCR, along with their files
+        pending = [row["id"] for row in self.db.execute('SELECT id FROM documents WHERE pending = 1')]
+        for doc_id in pending:
+            shutil.rmtree(self.doc_dir(doc_id), ignore_errors=True)
+            self.remove(doc_id)
+
+    def doc_dir(self, doc_id: int) -> str:
+        return os.path.join(self.directory, f'doc_{doc_id}')
+
+    def text_path(self, doc_id: int) -> str:
+        return os.path.join(self.doc_dir(doc_id), 'text.txt')
+
+    def documents(self) -> list[sqlite3.Row]:
+        # in the order they were added, without ones still being added
+        return self.db.execute('SELECT * FROM documents WHERE pending = 0 ORDER BY id').fetchall()
+
+    def get(self, doc_id: int) -> sqlite3.Row | None:
+        return self.db.execute('SELECT * FROM documents WHERE id = ?', (doc_id,)).fetchone()
+
+    def add(self, name: str | None = None) -> int:
+        # reserves an id (and so a directory) for a new document, named "Document <id>" by default. It stays
+        # pending, hidden from documents() and removed on the next start, until update(id, pending=0)
+        with self.db:
+            cursor = self.db.execute('INSERT INTO documents (name, added, pending) VALUES (?, ?, 1)',
+                                     (name or '', time.time()))
+            doc_id = cursor.lastrowid
+            if name is None:
+                self.db.execute('UPDATE documents SET name = ? WHERE id = ?', (f'Document {doc_id}', doc_id))
+        return doc_id
+
+    def update(self, doc_id: int, **fields: object) -> None:
+        # sets columns of one document, e.g. update(3, current_page=12, last_opened=time.time())
+        if not fields:
+            return
+        unknown = set(fields) - set(COLUMNS)
+        if unknown:
+            raise ValueError(f"Unknown document fields: {', '.join(sorted(unknown))}")
+        columns = ', '.join(f'{column} = ?' for column in fields)
+        with self.db:
+            self.db.execute(f'UPDATE documents SET {columns} WHERE id = ?', (*fields.values(), doc_id))
+
+    def remove(self, doc_id: int) -> None:
+        with self.db:
+            self.db.execute('DELETE FROM documents WHERE id = ?', (doc_id,))
+
+    def close(self) -> None:
+        self.db.close()
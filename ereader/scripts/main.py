@@ -1,38 +1,71 @@
 import time
+_start = time.perf_counter()  # before the imports, so the startup breakdown includes them
 import os
 from PIL import ImageFont, Image, ImageDraw
-import json
 
-from display import Display, Menu
+from display import Display, HighlightedPage, Menu, default_font
+from events import Event, EventLoop, EventType
 from fontmanager import Fontmanager
-from picolistener import PicoListener, Button
+from library import Library
+from picolistener import PicoListener, Button, PressKind
 from document import Document
+from pagecache import PageCache
+from searchindex import SearchIndex
 from tts import TTSPlayer
-from camera import DocumentCamera
-from ocr import process_images
+# camera and ocr pull in picamera2, pytesseract and spacy, so they are imported when capturing starts
+
+
+def is_navigation(event: Event) -> bool:
+    # a hold only announces that repeats follow, so it is not a step of its own
+    return (event.type == EventType.BUTTON and event.data.button in (Button.UP, Button.DOWN)
+            and event.data.kind in (PressKind.PRESS, PressKind.REPEAT))
+
+
+class StartupTimer:
+    def __init__(self, start: float) -> None:
+        self.start = start
+        self.last = start
+        self.stages: list[tuple[str, float]] = []
+
+    def mark(self, stage: str) -> None:
+        # records the time since the previous mark as stage
+        now = time.perf_counter()
+        self.stages.append((stage, now - self.last))
+        self.last = now
+
+    def report(self) -> None:
+        print(f"Started in {self.last - self.start:.3f}s: " + ", ".join(f"{stage} {seconds:.3f}s" for stage, seconds in self.stages))
 
 
 class App:
     def __init__(self) -> None:
-        self.button_listener = PicoListener()
+        self.startup: StartupTimer | None = StartupTimer(_start)
+        self.startup.mark("imports")
+        # the panel comes first so it shows the last saved screen while everything else starts
+        self.display = Display(50, boot_frame='cache/boot_frame.png')
+        self.startup.mark("display")
+        # buttons, playback, synthesis and rendering all report to this loop, screens run as its handlers
+        self.loop = EventLoop()
+        self.button_listener = PicoListener(lambda press: self.loop.post(EventType.BUTTON, press, press.arrived))
         self.button_listener.listening()
-        self.display = Display(50)
-        self.tts_player = TTSPlayer('tmp/tts')
-        self.library = []
-        try:
-            with open('library/.metadata.json', 'r') as file:
-                self.library = json.load(file)
-                if not isinstance(self.library, list):
-                    print("Library metadata is not a json list")
-        except FileNotFoundError:
-            pass
+        self.startup.mark("buttons")
+        self.tts_player = TTSPlayer('tmp/tts', on_sentence=self.loop.poster(EventType.SENTENCE_STARTED),
+                                    on_finished=self.loop.poster(EventType.PLAYBACK_FINISHED),
+                                    on_synthesized=self.loop.poster(EventType.SYNTH_DONE))
+        self.startup.mark("tts")
+        self.library = Library('library')
+        self.search_index = SearchIndex('library')
         self.fontmanager = Fontmanager()
         self.font: ImageFont = self.fontmanager.get_current_font()
         self.line_space = 10  # todo - also store in fontconfig?
+        self.startup.mark("library and fonts")
 
     def start(self) -> None:
+        # documents from before the search index existed, or changed since, are indexed while the menu is up
+        documents = [(document["id"], self.library.text_path(document["id"])) for document in self.library.documents()]
+        self.loop.run_in_background('search index', lambda: self.search_index.update(documents))
         while True:
-            match self.menu(["Library", "Settings"], back=False):
+            match self.menu(["Library", "Settings"], back=False, boot_screen=True):
                 case 0:
                     self.library_menu()
                 case 1:
@@ -40,16 +73,21 @@ class App:
 
     def library_menu(self) -> None:
         while True:
-            doc_selection = self.menu(self.library + ["Add new document"])
+            documents = self.library.documents()
+            doc_selection = self.menu([document["name"] for document in documents] + ["Add new document", "Search"])
             if doc_selection is None:
                 return
-            if doc_selection == len(self.library):
-                self.capture_images(f'library/doc_{len(self.library)}')
-                self.library.append(f'Document {len(self.library)}')
-                with open('library/.metadata.json', 'w') as file:
-                    json.dump(self.library, file)
+            if doc_selection == len(documents):
+                doc_id = self.library.add()
+                if not self.capture_images(self.library.doc_dir(doc_id)):
+                    continue  # OCR failed, the document stays pending and is removed on the next start
+                # the document shows up in the library only now that its text is written
+                self.library.update(doc_id, text_bytes=os.path.getsize(self.library.text_path(doc_id)), pending=0)
+                self.search_index.add_document(doc_id, self.library.text_path(doc_id))
+            elif doc_selection == len(documents) + 1:
+                self.search_menu()
             else:
-                self.read_document(doc_selection)
+                self.read_document(documents[doc_selection]["id"])
 
     def settings_menu(self) -> None:
         while True:
@@ -69,121 +107,272 @@ class App:
                         self.fontmanager.set_size(sizes[size_selection])
                         self.font = self.fontmanager.get_current_font()
 
-    def menu(self, items: list[str], back=True) -> int | None:
+    def search_menu(self) -> None:
+        query = ''
+        while True:
+            query = self.text_entry(query)
+            if not query:
+                return
+            results = self.search_index.search(query)
+            names = {document["id"]: document["name"] for document in self.library.documents()}
+            results = [result for result in results if result.doc_id in names]
+            if not results:
+                self.menu([f'No matches for {query}'])
+                continue
+            selection = self.menu([f'{names[result.doc_id]}: {result.snippet}' for result in results])
+            if selection is not None:
+                # opens straight at the page with the sentence
+                self.read_document(results[selection].doc_id, results[selection].position)
+                return
+
+    def text_entry(self, text: str = '') -> str | None:
+        # builds up text one character per menu selection, there being only four buttons
+        characters = list('abcdefghijklmnopqrstuvwxyz0123456789') + ['"']
+        items = [f'Search: {text}_', 'Delete', 'Space'] + characters
+        selected = 0
+        while True:
+            items[0] = f'Search: {text}_'
+            selection = self.menu(items, selected=selected)
+            match selection:
+                case None:
+                    return None
+                case 0:
+                    return text.strip()
+                case 1:
+                    text = text[:-1]
+                case 2:
+                    text += ' '
+                case _:
+                    text += items[selection]
+            selected = selection
+
+    def menu(self, items: list[str], back=True, boot_screen=False, selected: int = 0) -> int | None:
         menu = Menu(items, self.display.width, self.display.height - self.display.button_height, (20, 20))
+        menu.go_item(selected)
         self.display.draw_screen(menu.menu_image())
         self.display.draw_button_labels(["Down", "Back", "Select", "Up"])
         self.display.paint_canvas()
-        while True:
-            match self.button_listener.get_interrupt():
-                case Button.UP:
-                    menu.go_prev_item()
-                    self.display.draw_screen(menu.menu_image())
-                    self.display.paint_canvas()
-                case Button.DOWN:
-                    menu.go_next_item()
+        if boot_screen:
+            # the screen shown at startup is saved, so the next start can put it on the panel right away
+            if self.startup is not None:
+                self.startup.mark("first screen")
+                self.startup.report()
+                self.startup = None
+            self.display.save_boot_frame()
+
+        def handle(event: Event) -> None:
+            if event.type != EventType.BUTTON:
+                return
+            match event.data.button:
+                case Button.UP | Button.DOWN if is_navigation(event):
+                    menu.go_item((menu.selected - self.take_navigation(event)) % len(items))
                     self.display.draw_screen(menu.menu_image())
                     self.display.paint_canvas()
+                case _ if event.data.kind != PressKind.PRESS:
+                    pass  # holding select or back does not repeat them
                 case Button.SELECT:
-                    return menu.selected
+                    self.loop.stop(menu.selected)
                 case Button.BACK:
                     if back:
-                        return None
-
-    def read_document(self, id: int) -> None:
-        filename = f'library/doc_{id}/text.txt'
-        doc = Document(filename, self.display.width, self.display.height - self.display.button_height, self.font,
-                       self.line_space)
-        page = doc.get_current_page()
-        self.display.draw_screen(page.page_image())
+                        self.loop.stop(None)
+        return self.loop.run(handle)
+
+    def read_document(self, id: int, position: int | None = None) -> None:
+        # opens at the saved position, or position, right away; the exact page numbers before it are worked
+        # out in the background
+        saved = self.library.get(id)
+        page_hint = saved["current_page"]
+        if position is None:
+            position = saved["position"]
+        elif saved["page_count"] and saved["text_bytes"]:
+            page_hint = 1 + position * saved["page_count"] // saved["text_bytes"]
+        doc = Document(self.library.text_path(id), self.display.width, self.display.height - self.display.button_height,
+                       self.font, self.line_space, id, position=position, page_hint=page_hint,
+                       on_settled=self.loop.poster(EventType.LAYOUT_SETTLED))
+        pages = PageCache(doc, on_rendered=self.loop.poster(EventType.RENDER_DONE))
+        self.display.draw_screen(pages.get(doc.current_page))
         self.display.draw_button_labels(["Prev", "Library", "TTS", "Next"])
         self.display.paint_canvas()
-        while True:
-            match self.button_listener.get_interrupt():
-                case Button.UP:
-                    page = doc.next_page()
-                    if page is not None:
-                        self.display.draw_screen(page.page_image())
-                        self.display.paint_canvas()
-                case Button.DOWN:
-                    page = doc.prev_page()
+        doc.layout_in_background()
+        pages.prefetch(doc.current_page)
+
+        def settle() -> None:
+            # the same page stays on screen, cached images are dropped since page numbers have changed
+            if doc.settle():
+                pages.clear()
+                pages.prefetch(doc.current_page)
+
+        def handle(event: Event) -> None:
+            if event.type == EventType.LAYOUT_SETTLED:
+                settle()
+            if event.type != EventType.BUTTON:
+                return
+            match event.data.button:
+                case Button.UP | Button.DOWN if is_navigation(event):
+                    steps = self.take_navigation(event)
+                    if doc.current_page + steps < doc.first_page():
+                        settle()  # going back past where the document was opened
+                    # presses queued up during a refresh are turned in one go, so only the last page is rendered
+                    page = doc.go_to_page(doc.current_page + steps)
                     if page is not None:
-                        self.display.draw_screen(page.page_image())
+                        self.display.draw_screen(pages.get(doc.current_page))
                         self.display.paint_canvas()
+                        pages.prefetch(doc.current_page)
+                case _ if event.data.kind != PressKind.PRESS:
+                    pass
                 case Button.SELECT:
-                    self.tts_doc(doc)
+                    self.tts_doc(doc, pages)
+                    if doc.settle_ready():
+                        settle()  # LAYOUT_SETTLED was posted while reading aloud, and ignored there
                     self.display.draw_button_labels(["Prev", "Library", "TTS", "Next"])
                     self.display.paint_canvas()
+                    pages.prefetch(doc.current_page)
                 case Button.BACK:
                     self.tts_player.clean()
-                    return
+                    pages.stop()
+                    doc.stop_layout()
+                    doc.save_layout()
+                    self.library.update(id, current_page=doc.current_page, position=doc.position(),
+                                        last_opened=time.time(), page_count=doc.page_count(),
+                                        layout_complete=doc.layout_complete)
+                    self.loop.stop()
+        self.loop.run(handle)
 
-    def tts_doc(self, doc: Document) -> None:
+    def tts_doc(self, doc: Document, pages: PageCache) -> None:
         if self.tts_player.is_playing():
             self.tts_player.pause_resume()
         tts_dir = f'{doc.id}/{doc.current_page}'
         self.tts_player.add_sentences(f'{doc.id}/{doc.current_page}', doc.get_current_page().sentences)
-        if doc.get_next_page():
+        if doc.has_page(doc.current_page + 1):
             self.tts_player.add_sentences(f'{doc.id}/{doc.current_page + 1}', doc.get_next_page().sentences)
+        view = HighlightedPage(doc.get_current_page(), pages.get(doc.current_page))
         self.display.draw_button_labels(["Volume Down", "", "Stop", "Volume Up"])
-        while True:
-            match self.button_listener.check_interrupt():
-                case Button.UP:
-                    self.tts_player.volume_up()
-                case Button.DOWN:
-                    self.tts_player.volume_down()
-                case Button.SELECT:
-                    self.tts_player.stop()
-                    break
-                case Button.BACK:
-                    self.tts_player.play_prev(tts_dir)
-            if not self.tts_player.is_playing():
-                if self.tts_player.play_next(tts_dir):
-                    self.display.draw_screen(doc.get_current_page().draw_highlight_sentences(
-                        [self.tts_player.playing_sent[f'{doc.id}/{doc.current_page}'] - 1]))
-                    self.display.paint_canvas()
-                else:
-                    doc.next_page()
-                    tts_dir = f'{doc.id}/{doc.current_page}'
-                    self.tts_player.remove(f'{doc.id}/{doc.current_page - 1}')
-                    if doc.get_next_page():
-                        self.tts_player.add_sentences(f'{doc.id}/{doc.current_page + 1}', doc.get_next_page().sentences)
-            time.sleep(0.01)
-
-    def capture_images(self, directory: str) -> None:
-        # TODO: if we want to be able to add to existing files, should count the number of things in the dir here
-        camera = DocumentCamera(directory=directory)
-        self.display.draw_button_labels(["", "Finish", "Capture", "Retake"])
+        self.tts_player.play_sentence(tts_dir, 1)
+        next_queued = False  # whether the next page's sentences are queued behind this page's
+
+        def handle(event: Event) -> None:
+            nonlocal tts_dir, view, next_queued
+            match event.type:
+                case EventType.BUTTON:
+                    match event.data.button:
+                        case Button.UP if is_navigation(event):
+                            self.tts_player.volume_up()
+                        case Button.DOWN if is_navigation(event):
+                            self.tts_player.volume_down()
+                        case _ if event.data.kind != PressKind.PRESS:
+                            pass
+                        case Button.SELECT:
+                            self.tts_player.stop()
+                            self.loop.stop()
+                        case Button.BACK:
+                            self.tts_player.play_prev(tts_dir)
+                            next_queued = False
+                case EventType.SENTENCE_STARTED:
+                    if event.data != self.tts_player.playing():
+                        return  # already replaced, e.g. by play_prev or a later sentence
+                    dirname, num = event.data
+                    if dirname != tts_dir:
+                        # playback has continued into the next page
+                        doc.next_page()
+                        self.tts_player.remove(tts_dir)
+                        tts_dir = f'{doc.id}/{doc.current_page}'
+                        view = HighlightedPage(doc.get_current_page(), pages.get(doc.current_page))
+                        self.display.draw_screen(view.image)
+                        pages.prefetch(doc.current_page)
+                        next_queued = False
+                        if doc.has_page(doc.current_page + 1):
+                            self.tts_player.add_sentences(f'{doc.id}/{doc.current_page + 1}', doc.get_next_page().sentences)
+                    self.show_highlight(view, num - 1)
+                    if not next_queued and f'{doc.id}/{doc.current_page + 1}' in self.tts_player.tts_keys:
+                        self.tts_player.queue_sentences(f'{doc.id}/{doc.current_page + 1}')
+                        next_queued = True
+                case EventType.PLAYBACK_FINISHED:
+                    # may be left over from before play_prev or an earlier session
+                    if not self.tts_player.is_playing():
+                        self.loop.stop()  # reached the end of the document
+        self.loop.run(handle)
+
+    def take_navigation(self, event: Event) -> int:
+        # net count of UP minus DOWN in event and the navigation presses queued right behind it
+        presses = [event.data] + [e.data for e in self.loop.take_while(is_navigation)]
+        return sum(1 if press.button == Button.UP else -1 for press in presses)
+
+    def show_highlight(self, view: HighlightedPage, sentence: int) -> None:
+        # only the boxes of the previous and new sentence change, so only they are pasted and refreshed
+        box = view.highlight([sentence])
+        if box is not None:
+            self.display.draw_screen(view.image.crop(box), box[:2])
+        self.display.paint_canvas()
+
+    def show_message(self, text: str) -> None:
         image = Image.new("1", (self.display.width, self.display.height - self.display.button_height), 255)
         draw = ImageDraw.Draw(image)
-        draw.font = ImageFont.load_default(20)
-        draw.text((self.display.width / 2, (self.display.height - self.display.button_height) / 2), "Capturing Images", anchor="mm", fill="black")
+        draw.font = default_font(20)
+        draw.text((self.display.width / 2, (self.display.height - self.display.button_height) / 2), text, anchor="mm", fill="black")
         self.display.draw_screen(image)
         self.display.paint_canvas()
-        while True:
-            match self.button_listener.check_interrupt():
-                case Button.UP:
-                    camera.retake_image()
-                    pass  # retake last image?
-                case Button.DOWN:
-                    pass  # no idea what this would be, trigger auto focus probably?
-                case Button.SELECT:
-                    camera.capture_image()
-                case Button.BACK:
-                    images = camera.done_capturing()
-                    self.display.draw_button_labels(["", "", "", ""])
-                    image = Image.new("1", (self.display.width, self.display.height - self.display.button_height), 255)
-                    draw = ImageDraw.Draw(image)
-                    draw.font = ImageFont.load_default(20)
-                    draw.text((self.display.width / 2, (self.display.height - self.display.button_height) / 2), "Running OCR (slowly)", anchor="mm", fill="black")
-                    self.display.draw_screen(image)
-                    self.display.paint_canvas()
-                    text_lines = process_images(images)
+
+    def capture_images(self, directory: str) -> bool:
+        # returns whether the text was read and written to text.txt
+        # TODO: if we want to be able to add to existing files, should count the number of things in the dir here
+        from camera import DocumentCamera
+        from ocr import OcrPipeline, sentencize
+        camera = DocumentCamera(directory=directory)
+        self.display.draw_button_labels(["", "Finish", "Capture", "Retake"])
+        self.show_message("Capturing Images")
+        # pages are read in the background as soon as they are captured, so Finish only waits for the last few
+        pipeline = OcrPipeline(on_progress=lambda done, total: self.loop.post(EventType.TASK_PROGRESS, ('ocr', done, total)))
+        finishing = False
+        failed = False
+
+        def read_text() -> list[str]:
+            text_lines = sentencize(''.join(pipeline.finish()))
+            # only the text is kept, the full resolution frames were just for OCR (and stay if it failed)
+            for image in camera.images:
+                image.remove()
+            return text_lines
+
+        def handle(event: Event) -> None:
+            nonlocal finishing, failed
+            match event.type:
+                case EventType.BUTTON if failed and event.data.kind == PressKind.PRESS:
+                    self.loop.stop()
+                case EventType.BUTTON if not finishing and event.data.kind == PressKind.PRESS:
+                    match event.data.button:
+                        case Button.UP:
+                            # retake last image, only its page is read again
+                            image = camera.retake_image()
+                            pipeline.submit(len(camera.images) - 1, image)
+                        case Button.DOWN:
+                            pass  # no idea what this would be, trigger auto focus probably?
+                        case Button.SELECT:
+                            pipeline.submit(len(camera.images), camera.capture_image())
+                        case Button.BACK:
+                            camera.done_capturing()
+                            self.display.draw_button_labels(["", "", "", ""])
+                            self.show_message("Running OCR")
+                            finishing = True
+                            self.loop.run_in_background('ocr', read_text)
+                case EventType.TASK_PROGRESS if event.data[0] == 'ocr':
+                    _, done, total = event.data
+                    if finishing:
+                        self.show_message(f"Running OCR ({done}/{total} pages)")
+                    else:
+                        self.show_message(f"Capturing Images ({done}/{total} pages read)")
+                case EventType.TASK_DONE if event.data[0] == 'ocr':
+                    text_lines = event.data[1]
+                    if text_lines is None:
+                        # the error has been printed, an empty text would only add an empty document
+                        failed = True
+                        self.show_message("OCR failed, press any button")
+                        return
                     os.makedirs(directory, exist_ok=True)
                     with open(f"{directory}/text.txt", 'w') as file:
                         for line in text_lines:
                             file.write(line + '\n')
-                    break  # done capturing?
+                    self.loop.stop()  # done capturing?
+        self.loop.run(handle)
+        return not failed
 
 
 if __name__ == '__main__':
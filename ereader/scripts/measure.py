@@ -0,0 +1,66 @@
+from PIL import ImageFont
+
+from fontmanager import font_key
+
+
+class TextMeasurer:
+    """
+    Caches text advance widths for one font, so line breaking can add up widths of words it has
+    already measured instead of running FreeType over the whole line for every word.
+
+    Widths are in the same 1/64 pixel units that ImageDraw.textlength returns, so sums are exact.
+    Kerning between the last glyph of a line and the next space or word is added from a cache of
+    per character pair corrections. With basic layout this reproduces textlength exactly; other
+    layout engines may shape across words, so callers re-measure lines that come close to the limit.
+    """
+    _measurers: dict[tuple[str, str], 'TextMeasurer'] = {}
+
+    def __init__(self, font: ImageFont.FreeTypeFont | ImageFont.ImageFont, mode: str = "1") -> None:
+        # mode must match the fontmode of the ImageDraw the text is drawn with ("1" for 1-bit images)
+        self.font = font
+        self.mode = mode
+        self.widths: dict[str, float] = {}
+        self.pair_corrections: dict[str, float] = {}
+        self.exact = getattr(font, 'layout_engine', ImageFont.Layout.BASIC) == ImageFont.Layout.BASIC
+        self.space_width = self.length(' ')
+
+    @classmethod
+    def for_font(cls, font: ImageFont.FreeTypeFont | ImageFont.ImageFont, mode: str = "1") -> 'TextMeasurer':
+        # fonts are reloaded whenever the settings change, so share measurements between equal fonts
+        key = (font_key(font), mode)
+        if key not in cls._measurers:
+            cls._measurers[key] = TextMeasurer(font, mode)
+        return cls._measurers[key]
+
+    def length(self, text: str) -> float:
+        width = self.widths.get(text)
+        if width is None:
+            width = self.widths[text] = self.font.getlength(text, self.mode)
+        return width
+
+    def pair_correction(self, left: str, right: str) -> float:
+        # difference between measuring two characters together and apart, i.e. their kerning
+        pair = left + right
+        correction = self.pair_corrections.get(pair)
+        if correction is None:
+            correction = self.length(pair) - self.length(left) - self.length(right)
+            self.pair_corrections[pair] = correction
+        return correction
+
+    def extend_line(self, last_char: str, line_length: float, word: str) -> float:
+        # length of line + ' ' + word, given the length and last character of line ('' if it is empty)
+        length = line_length + self.space_width + self.length(word)
+        if last_char:
+            length += self.pair_correction(last_char, ' ')
+        if word:
+            length += self.pair_correction(' ', word[0])
+        return length
+
+    def join_length(self, words: list[str]) -> float:
+        # length of ' '.join(words)
+        length = self.length(words[0])
+        last_char = words[0][-1:]
+        for word in words[1:]:
+            length = self.extend_line(last_char, length, word)
+            last_char = word[-1:] or ' '
+        return length
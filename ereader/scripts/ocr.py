@@ -1,27 +1,226 @@
-from PIL import Image,ImageEnhance
+from concurrent.futures import CancelledError, Future, ProcessPoolExecutor
+import multiprocessing
+import os
+import threading
+import time
+from typing import Callable
+from PIL import Image
 import pytesseract
 from spacy.lang.en import English
 
+from imagefile import ImageFile
+from preprocess import STEPS, preprocess
 
-def image_to_text(image: Image, delete_image: bool = True) -> str:
+
+def image_to_text(image: Image, delete_image: bool = True, steps: tuple[str, ...] = STEPS) -> str:
     #image = Image.open(image_file).convert("L")
-    contrast_enhancer=ImageEnhance.Contrast(image)
-    enhanced=contrast_enhancer.enhance(1.4)
-    sharpness_enhancer=ImageEnhance.Sharpness(enhanced)
-    final_image=sharpness_enhancer.enhance(1.4)
-    text = pytesseract.image_to_string(final_image)
+    text = pytesseract.image_to_string(preprocess(image, steps)[0])
     return text
 
-def process_images(images: list[Image]) -> list[str]: #file_names: list[str]) -> list[str]:
-    new_text = ""
-    for image in images:
-        new_text += image_to_text(image)
+def strip_bounds(height: int, strip_height: int, overlap: int) -> list[tuple[int, int, int, int]]:
+    # (top, bottom, own_top, own_bottom) of each strip; strips overlap so no text line is only ever seen cut in half,
+    # and a line is kept only by the strip that owns its centre, the owned ranges meeting in the middle of each overlap
+    step = max(1, strip_height - overlap)
+    tops = list(range(0, max(1, height - overlap), step))
+    bounds = []
+    for i, top in enumerate(tops):
+        bottom = min(height, top + strip_height)
+        own_top = 0 if i == 0 else top + overlap // 2
+        own_bottom = height if i == len(tops) - 1 else tops[i + 1] + overlap // 2
+        bounds.append((top, bottom, own_top, own_bottom))
+    return bounds
+
+def strip_to_lines(strip: Image, top: int, own_top: int, own_bottom: int) -> list[str]:
+    # text lines of one (preprocessed) strip whose vertical centre, in page coordinates, lies in the strip's own range
+    data = pytesseract.image_to_data(strip, output_type=pytesseract.Output.DICT)
+    lines: dict[tuple[int, int, int], list[int]] = {}
+    for i, word in enumerate(data["text"]):
+        if word.strip():
+            lines.setdefault((data["block_num"][i], data["par_num"][i], data["line_num"][i]), []).append(i)
+    kept = []
+    for words in lines.values():
+        line_top = min(data["top"][i] for i in words)
+        line_bottom = max(data["top"][i] + data["height"][i] for i in words)
+        centre = top + (line_top + line_bottom) / 2
+        if own_top <= centre < own_bottom:
+            kept.append((line_top, ' '.join(data["text"][i] for i in sorted(words, key=lambda i: data["left"][i]))))
+    return [text for _, text in sorted(kept, key=lambda line: line[0])]
+
+def _prepare(image: Image.Image | ImageFile, steps: tuple[str, ...]) -> tuple[Image, dict[str, float]]:
+    # runs in a worker process, which loads pages saved to disk itself
+    if isinstance(image, ImageFile):
+        image = image.load()
+    return preprocess(image, steps)
+
+def _ocr_task(image: Image.Image | ImageFile, strip: tuple[int, int, int] | None, steps: tuple[str, ...]
+              ) -> tuple[str, dict[str, float]]:
+    # runs in a worker process: a whole page, or a preprocessed strip of one given as (top, own_top, own_bottom).
+    # Returns the text and the seconds each step took
+    image, timings = _prepare(image, steps)
+    start = time.perf_counter()
+    if strip is None:
+        text = pytesseract.image_to_string(image)
+    else:
+        text = ''.join(line + '\n' for line in strip_to_lines(image, *strip))
+    timings["ocr"] = time.perf_counter() - start
+    return text, timings
+
+def _init_worker() -> None:
+    # tesseract would otherwise start a thread per core in every worker process
+    os.environ["OMP_THREAD_LIMIT"] = "1"
+
+def page_tasks(image: Image, strip_height: int | None, overlap: int) -> list[tuple[Image, tuple[int, int, int] | None]]:
+    # the (image, strip) tasks whose texts make up the page, in order
+    if strip_height is None or image.height <= strip_height:
+        return [(image, None)]
+    # cropped here so only the strip's pixels are sent to its worker
+    return [(image.crop((0, top, image.width, bottom)), (top, own_top, own_bottom))
+            for top, bottom, own_top, own_bottom in strip_bounds(image.height, strip_height, overlap)]
+
+class _Page:
+    def __init__(self) -> None:
+        self.futures: list[Future] = []  # the tasks currently working on the page
+        self.texts: list[str] | None = None
+        self.error: Exception | None = None
+        self.done = threading.Event()
+        self.collected = False  # set by the one callback that collects the results
+        self.replaced = False
+
+class OcrPipeline:
+    """
+    OCRs pages on a pool of worker processes as they are submitted, so reading can overlap with capturing the
+    next page. Each page is preprocessed (see preprocess.STEPS) and read in one task, or, for pages taller than
+    strip_height once preprocessed, preprocessed first and then read in overlapping strips.
+    Submitting a page again replaces its earlier image. on_progress(done, total) is called from the pool's
+    threads whenever a page finishes or is submitted. timings adds up the seconds spent in each step.
+    """
+    def __init__(self, workers: int | None = None, strip_height: int | None = None, overlap: int = 120,
+                 on_progress: Callable[[int, int], None] | None = None, steps: tuple[str, ...] = STEPS) -> None:
+        # the app has threads running (buttons, audio, synthesis, prefetch), and forking a threaded process can
+        # leave a lock held in the child, so workers come from a fork server that only has this module loaded
+        context = multiprocessing.get_context("forkserver")
+        context.set_forkserver_preload(["ocr"])
+        self.pool = ProcessPoolExecutor(max_workers=workers or os.cpu_count(), mp_context=context,
+                                        initializer=_init_worker)
+        self.strip_height = strip_height
+        self.overlap = overlap
+        self.on_progress = on_progress
+        self.steps = steps
+        self.pages: list[_Page] = []
+        self.timings: dict[str, float] = {}
+        self.lock = threading.Lock()
+
+    def submit(self, index: int, image: Image.Image | ImageFile) -> None:
+        # index is a page already submitted, which is then replaced, or the next one
+        page = _Page()
+        replaced = None
+        with self.lock:
+            if index < len(self.pages):
+                replaced = self.pages[index]
+                replaced.replaced = True
+                self.pages[index] = page
+            else:
+                self.pages.append(page)
+        if replaced is not None:
+            # the old image's result is no longer wanted; tasks that already started just finish unused.
+            # cancel runs done callbacks right away, so this must not hold the lock
+            for future in replaced.futures:
+                future.cancel()
+        self._report()
+        if self.strip_height is None:
+            self._read(page, [(image, None)], self.steps)
+        else:
+            # waits for the preprocessed page on its own thread; submitting from a done callback can deadlock the pool
+            threading.Thread(target=self._read_in_strips, args=(page, image), daemon=True).start()
+
+    def _read_in_strips(self, page: _Page, image: Image.Image | ImageFile) -> None:
+        prepared = self.pool.submit(_prepare, image, self.steps)
+        page.futures = [prepared]
+        try:
+            image, timings = prepared.result()
+        except CancelledError:
+            return
+        except Exception as e:
+            self._finish_page(page, error=e)
+            return
+        if page.replaced:
+            return
+        self._add_timings(timings)
+        self._read(page, page_tasks(image, self.strip_height, self.overlap), ())
+
+    def _read(self, page: _Page, tasks: list[tuple[Image.Image | ImageFile, tuple[int, int, int] | None]],
+              steps: tuple[str, ...]) -> None:
+        futures = [self.pool.submit(_ocr_task, image, strip, steps) for image, strip in tasks]
+        page.futures = futures
+        for future in futures:
+            future.add_done_callback(lambda future: self._task_done(page, futures))
+
+    def _task_done(self, page: _Page, futures: list[Future]) -> None:
+        with self.lock:
+            if page.replaced or page.collected or not all(future.done() for future in futures):
+                return
+            page.collected = True
+        try:
+            results = [future.result() for future in futures]
+        except Exception as e:
+            self._finish_page(page, error=e)
+            return
+        for _, timings in results:
+            self._add_timings(timings)
+        self._finish_page(page, texts=[text for text, _ in results])
+
+    def _finish_page(self, page: _Page, texts: list[str] | None = None, error: Exception | None = None) -> None:
+        page.texts = texts
+        page.error = error
+        page.done.set()
+        self._report()
+
+    def _add_timings(self, timings: dict[str, float]) -> None:
+        with self.lock:
+            for step, seconds in timings.items():
+                self.timings[step] = self.timings.get(step, 0.0) + seconds
+
+    def _report(self) -> None:
+        if self.on_progress is None:
+            return
+        with self.lock:
+            done = sum(page.texts is not None or page.error is not None for page in self.pages)
+            total = len(self.pages)
+        self.on_progress(done, total)
+
+    def finish(self) -> list[str]:
+        # waits only for the pages still being read, then returns the text of each page in page order
+        with self.lock:
+            pages = list(self.pages)
+        try:
+            for page in pages:
+                page.done.wait()
+                if page.error is not None:
+                    raise page.error
+        finally:
+            self.pool.shutdown(cancel_futures=True)
+        print("OCR step times: " + ", ".join(f"{step} {seconds:.2f}s" for step, seconds in self.timings.items()))
+        return [''.join(page.texts) for page in pages]
+
+def ocr_pages(images: list[Image.Image | ImageFile], workers: int | None = None, strip_height: int | None = None, overlap: int = 120,
+              on_progress: Callable[[int, int], None] | None = None, steps: tuple[str, ...] = STEPS) -> list[str]:
+    # the text of each page, in page order
+    pipeline = OcrPipeline(workers, strip_height, overlap, on_progress, steps)
+    for index, image in enumerate(images):
+        pipeline.submit(index, image)
+    return pipeline.finish()
+
+def sentencize(text: str) -> list[str]:
     nlp = English()
     nlp.add_pipe("sentencizer")
-    doc = nlp(new_text.replace('\n', ' '))
+    doc = nlp(text.replace('\n', ' '))
 
     return [sent.text for sent in doc.sents]
 
+def process_images(images: list[Image.Image | ImageFile], workers: int | None = None, strip_height: int | None = None,
+                   on_progress: Callable[[int, int], None] | None = None) -> list[str]: #file_names: list[str]) -> list[str]:
+    return sentencize(''.join(ocr_pages(images, workers, strip_height, on_progress=on_progress)))
+
 # image_files = [
 #     "ereader/test_document/ocr-sample2.png",
 #     "ereader/test_document/testocr.png"
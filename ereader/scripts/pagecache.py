@@ -0,0 +1,94 @@
+from collections import OrderedDict
+import queue
+import threading
+from typing import Callable
+from PIL import Image
+
+from document import Document
+
+
+class PageCache:
+    """
+    Bounded LRU cache of rendered page images for one document.
+    A background worker renders the pages around the current one while the user is reading,
+    so turning the page only has to paste a finished image.
+    """
+    def __init__(self, doc: Document, capacity: int = 8, radius: int = 2,
+                 on_rendered: Callable[[int], None] | None = None) -> None:
+        self.doc = doc
+        self.on_rendered = on_rendered  # called from the worker with each page number it rendered
+        self.radius = radius  # pages on each side of the current page rendered ahead of time
+        self.capacity = max(capacity, 2 * radius + 1)
+        self.images: OrderedDict[int, Image] = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.prefetched = 0
+        self.generation = 0  # bumped by clear, so renders started before it are not stored
+        self.requests = queue.Queue()
+        self.worker = threading.Thread(target=self._prefetch_worker, daemon=True)
+        self.worker.start()
+
+    def get(self, num: int) -> Image:
+        with self.lock:
+            image = self.images.get(num)
+            if image is not None:
+                self.images.move_to_end(num)
+                self.hits += 1
+                return image
+            self.misses += 1
+            generation = self.generation
+        image = self.doc.get_page(num).page_image()
+        self._store(num, image, generation)
+        return image
+
+    def _store(self, num: int, image: Image, generation: int) -> None:
+        with self.lock:
+            if generation != self.generation:
+                return
+            self.images[num] = image
+            self.images.move_to_end(num)
+            while len(self.images) > self.capacity:
+                self.images.popitem(last=False)
+
+    def prefetch(self, center: int) -> None:
+        # render center +- radius in the background, nearest pages first and the next page before the previous
+        self.requests.put(center)
+
+    def _prefetch_worker(self) -> None:
+        while True:
+            center = self.requests.get()
+            # only the newest request matters if the user turned several pages in the meantime
+            while center is not None and not self.requests.empty():
+                center = self.requests.get()
+            if center is None:
+                return
+            for distance in range(self.radius + 1):
+                for num in (center + distance, center - distance) if distance else (center,):
+                    if not self.requests.empty():
+                        break
+                    with self.lock:
+                        cached = num in self.images
+                        generation = self.generation
+                    if num < 1 or cached:
+                        continue
+                    try:
+                        page = self.doc.get_page(num)
+                    except ValueError:
+                        continue
+                    self._store(num, page.page_image(), generation)
+                    self.prefetched += 1
+                    if self.on_rendered is not None:
+                        self.on_rendered(num)
+
+    def clear(self) -> None:
+        # drops every image, e.g. once the document's page numbers have changed
+        with self.lock:
+            self.images.clear()
+            self.generation += 1
+
+    def stats(self) -> dict[str, int]:
+        return {"hits": self.hits, "misses": self.misses, "prefetched": self.prefetched, "cached": len(self.images)}
+
+    def stop(self) -> None:
+        self.requests.put(None)
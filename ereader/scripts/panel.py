@@ -0,0 +1,162 @@
+from abc import ABC, abstractmethod
+import os
+import time
+from PIL import Image
+
+from framebuffer import FrameBuffer
+
+
+class PanelDriver(ABC):
+    """
+    Interface between Display and an e-paper panel.
+    Frames are mode "1" images in the panel's orientation, regions are (x0, y0, x1, y1) boxes
+    with x0 and x1 on byte boundaries.
+    """
+    width = 800
+    height = 480
+    supports_regions = False
+
+    def init(self) -> None:
+        pass
+
+    @abstractmethod
+    def clear(self) -> None:
+        pass
+
+    @abstractmethod
+    def show_frame(self, image: Image) -> None:
+        pass
+
+    @abstractmethod
+    def show_regions(self, image: Image, regions: list[tuple[int, int, int, int]]) -> None:
+        # only called when supports_regions is set
+        pass
+
+    def sleep(self) -> None:
+        pass
+
+
+class WaveshareDriver(PanelDriver):
+    """The Waveshare 4.26 inch panel."""
+    def __init__(self) -> None:
+        # imported here so the rest of the app can run on machines without the panel libraries
+        from waveshare_epd import epd4in26
+        self.epd = epd4in26.EPD()
+        self.width = self.epd.width
+        self.height = self.epd.height
+        self.framebuffer = FrameBuffer(self.width, self.height)
+        # window writes need the driver's RAM addressing helpers
+        self.supports_regions = all(hasattr(self.epd, name) for name in
+                                    ("SetWindow", "SetCursor", "send_data2", "TurnOnDisplay_Part"))
+
+    def init(self) -> None:
+        self.epd.init()
+
+    def clear(self) -> None:
+        self.epd.Clear()
+
+    def show_frame(self, image: Image) -> None:
+        self.epd.display_Partial(self.framebuffer.pack(image))
+
+    def show_regions(self, image: Image, regions: list[tuple[int, int, int, int]]) -> None:
+        # writes only the changed windows into the panel RAM, then runs one partial update for all of them
+        for x0, y0, x1, y1 in regions:
+            self.epd.SetWindow(x0, y0, x1 - 1, y1 - 1)
+            self.epd.SetCursor(x0, y0)
+            self.epd.send_command(0x24)  # write black/white RAM
+            self.epd.send_data2(self.framebuffer.pack_region(image, (x0, y0, x1, y1)))
+        self.epd.TurnOnDisplay_Part()
+
+    def sleep(self) -> None:
+        self.epd.sleep()
+
+
+class SimulatedPanel(PanelDriver):
+    """
+    Headless stand-in for the panel with the same geometry, for profiling and testing rendering off the device.
+    Frames are kept in memory and optionally written to output_dir as PNGs. Refreshes sleep for the
+    configured latencies so page turn timings resemble the real panel.
+    """
+    supports_regions = True
+
+    def __init__(self, width: int = 800, height: int = 480, output_dir: str | None = None,
+                 full_refresh_latency: float = 0.0, partial_refresh_latency: float = 0.0,
+                 keep_frames: bool = False) -> None:
+        self.width = width
+        self.height = height
+        self.output_dir = output_dir
+        self.full_refresh_latency = full_refresh_latency
+        self.partial_refresh_latency = partial_refresh_latency
+        self.keep_frames = keep_frames
+        self.framebuffer = FrameBuffer(width, height)
+        self.frame = Image.new("1", (width, height), 255)  # what the panel currently shows
+        self.frames: list[Image] = []
+        self.full_refreshes = 0
+        self.partial_refreshes = 0
+        self.bytes_sent = 0  # what would have gone over SPI
+        if output_dir:
+            os.makedirs(output_dir, exist_ok=True)
+
+    def clear(self) -> None:
+        self.frame.paste(255, (0, 0, self.width, self.height))
+        self.full_refreshes += 1
+        time.sleep(self.full_refresh_latency)
+        self._record()
+
+    def show_frame(self, image: Image) -> None:
+        self.bytes_sent += len(self.framebuffer.pack(image))
+        self.frame.paste(image.convert("1"))
+        self.partial_refreshes += 1
+        time.sleep(self.partial_refresh_latency)
+        self._record()
+
+    def show_regions(self, image: Image, regions: list[tuple[int, int, int, int]]) -> None:
+        for box in regions:
+            self.bytes_sent += len(self.framebuffer.pack_region(image, box))
+            self.frame.paste(image.crop(box), box[:2])
+        self.partial_refreshes += 1
+        time.sleep(self.partial_refresh_latency)
+        self._record()
+
+    def _record(self) -> None:
+        if self.keep_frames:
+            self.frames.append(self.frame.copy())
+        if self.output_dir:
+            count = self.full_refreshes + self.partial_refreshes
+            self.frame.save(os.path.join(self.output_dir, f"frame_{count:05d}.png"))
+
+
+def make_driver() -> PanelDriver:
+    # EREADER_DISPLAY=simulated runs without the panel, EREADER_SIM_DIR saves its frames as PNGs
+    if os.environ.get("EREADER_DISPLAY", "waveshare") == "simulated":
+        return SimulatedPanel(output_dir=os.environ.get("EREADER_SIM_DIR"),
+                              full_refresh_latency=float(os.environ.get("EREADER_SIM_FULL_LATENCY", 0)),
+                              partial_refresh_latency=float(os.environ.get("EREADER_SIM_PARTIAL_LATENCY", 0)))
+    return WaveshareDriver()
+
+
+if __name__ == "__main__":
+    # page turn benchmark on the simulated panel, run from the ereader directory
+    from PIL import ImageFont
+    from display import Display
+    from document import Document
+    from pagecache import PageCache
+
+    panel = SimulatedPanel()
+    display = Display(50, panel)
+    doc = Document("library/doc_0/text.txt", display.width, display.height - display.button_height,
+                   ImageFont.load_default(23), 10)
+    pages = PageCache(doc)
+    turn_time = 0.0
+    turns = 0
+    page = doc.get_current_page()
+    while page is not None:
+        start = time.perf_counter()
+        display.draw_screen(pages.get(doc.current_page))
+        display.paint_canvas()
+        turn_time += time.perf_counter() - start
+        pages.prefetch(doc.current_page)
+        time.sleep(0.2)  # reading time, when the prefetch worker runs
+        page = doc.next_page()
+        turns += 1
+    print(f"{turns} pages shown in {turn_time:.3f}s, {panel.bytes_sent} bytes sent, cache {pages.stats()}")
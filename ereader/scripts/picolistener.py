@@ -1,7 +1,11 @@
 from enum import Enum
+import os
+import select
 import serial
 import threading
 import queue
+import time
+from typing import Callable
 
 class Button(Enum):
     SELECT = 1
@@ -9,44 +13,133 @@ class Button(Enum):
     UP = 3
     DOWN = 4
 
+class PressKind(Enum):
+    PRESS = 1  # button went down
+    HOLD = 2  # button has been held past the long press time
+    REPEAT = 3  # sent periodically while the button stays held, for fast scrolling
+
+KINDS = {"p": PressKind.PRESS, "h": PressKind.HOLD, "r": PressKind.REPEAT}
+SEQ_MODULO = 1 << 16
+
+
+class ButtonPress:
+    def __init__(self, button: Button, kind: PressKind = PressKind.PRESS, seq: int | None = None,
+                 ticks: int | None = None, arrived: float = 0.0) -> None:
+        self.button = button
+        self.kind = kind
+        self.seq = seq  # None for the legacy protocol
+        self.ticks = ticks  # device time in ms (wraps around), None for the legacy protocol
+        self.arrived = arrived  # host monotonic time the bytes were read
+
+    def __repr__(self) -> str:
+        return f'ButtonPress({self.button.name}, {self.kind.name}, seq={self.seq}, ticks={self.ticks})'
+
+
 class PicoListener:
-    def __init__(self) -> None:
-        self.PORT = "/dev/ttyACM0"
-        self.BAUDRATE = 115200
+    """
+    Reads button events sent by the pico over USB serial, one per line, in either format:
+
+        <button>                           legacy, a press of button 1-4
+        <seq> <ticks_ms> <button> <kind>   seq counts up mod 2**16, kind is p (press), h (hold) or r (repeat)
+
+    Gaps in seq mean the device sent events that were lost and are counted in dropped; events whose
+    seq is not ahead of the last one are duplicates and are discarded. seq 0 marks a device restart.
+    The reader thread sleeps in select until bytes arrive or stop_listening wakes it, then parses
+    every complete line it has received at once. Each event records the monotonic time its bytes
+    arrived. port can be any serial device, e.g. one end of a pty pair for testing.
+    """
+    def __init__(self, on_button: Callable[[ButtonPress], None] | None = None,
+                 port: str = "/dev/ttyACM0", baudrate: int = 115200) -> None:
+        self.PORT = port
+        self.BAUDRATE = baudrate
         self.DICT = ("select", "back", "up", "down")
-        self.ser = serial.Serial(self.PORT, self.BAUDRATE, timeout=1)
+        self.ser = serial.Serial(self.PORT, self.BAUDRATE, timeout=0)
         self.queue = queue.Queue()
+        # presses go to on_button (e.g. an event loop) if given, otherwise into self.queue
+        self.on_button = on_button if on_button is not None else self.queue.put
+        self.last_seq: int | None = None
+        self.dropped = 0  # events the device sent that never arrived, from sequence gaps
+        self.duplicates = 0
         self.stop_event = threading.Event()  # Event to stop the thread
+        self.wake_read, self.wake_write = os.pipe()  # written to by stop_listening to interrupt select
+        self.buffer = b''  # bytes of a line that has not been completed yet
+        self.thread: threading.Thread | None = None
 
     def read_signal(self) -> None:
         while not self.stop_event.is_set():  # Check if the thread should stop
-            if self.ser.in_waiting > 0:
-                try:
-                    message = int(self.ser.readline().decode('utf-8').strip())
-                    self.queue.put(Button(message))
-                except Exception as e:
-                    print(f"Error reading signal: {e}")
+            readable, _, _ = select.select([self.ser.fileno(), self.wake_read], [], [])
+            if self.stop_event.is_set():
+                break
+            if self.ser.fileno() not in readable:
+                continue
+            arrived = time.monotonic()
+            try:
+                data = self.ser.read(max(1, self.ser.in_waiting))
+            except serial.SerialException as e:
+                print(f"Error reading signal: {e}")
+                break
+            self.parse(data, arrived)
+
+    def parse(self, data: bytes, arrived: float) -> None:
+        lines = (self.buffer + data).split(b'\n')
+        self.buffer = lines.pop()
+        for line in lines:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                press = self.parse_line(line.decode('utf-8'), arrived)
+            except (ValueError, KeyError, UnicodeDecodeError) as e:
+                print(f"Error reading signal {line!r}: {e}")
+                continue
+            if press is not None:
+                self.on_button(press)
+
+    def parse_line(self, line: str, arrived: float) -> ButtonPress | None:
+        # None if the event is a duplicate
+        fields = line.split()
+        if len(fields) == 1:
+            return ButtonPress(Button(int(fields[0])), arrived=arrived)
+        if len(fields) != 4:
+            raise ValueError(f"expected 1 or 4 fields, got {len(fields)}")
+        seq, ticks, button, kind = int(fields[0]), int(fields[1]), Button(int(fields[2])), KINDS[fields[3]]
+        if self.last_seq is not None and seq != 0:
+            ahead = (seq - self.last_seq) % SEQ_MODULO
+            if ahead == 0 or ahead > SEQ_MODULO // 2:
+                self.duplicates += 1
+                return None
+            if ahead > 1:
+                self.dropped += ahead - 1
+                print(f"Lost {ahead - 1} button events before {seq}")
+        self.last_seq = seq
+        return ButtonPress(button, kind, seq, ticks, arrived)
 
     def listening(self) -> None:
-        listener_thread = threading.Thread(target=self.read_signal)
-        listener_thread.daemon = True
-        listener_thread.start()
+        self.thread = threading.Thread(target=self.read_signal)
+        self.thread.daemon = True
+        self.thread.start()
 
     def get_signal_queue(self) -> queue.Queue:
         return self.queue
 
-    def check_interrupt(self) -> Button | None:
+    def check_interrupt(self) -> ButtonPress | None:
         try:
             return self.queue.get_nowait()
         except queue.Empty:
             return None
 
-    def get_interrupt(self) -> Button:
+    def get_interrupt(self) -> ButtonPress:
         return self.queue.get()
 
     def stop_listening(self) -> None:
         self.stop_event.set()  # Signal the thread to stop
+        os.write(self.wake_write, b'\0')
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
         self.ser.close()  # Close the serial connection
+        os.close(self.wake_read)
+        os.close(self.wake_write)
 
 
 if __name__ == "__main__":
@@ -55,9 +148,8 @@ if __name__ == "__main__":
     print("Start Listening")
     try:
         while True:
-            signal = listener.check_interrupt()  # Check for signals in the queue
-            if signal:
-                print(f"Received signal: {signal.name}")  # Print the signal to the terminal
+            signal = listener.get_interrupt()  # Wait for the next signal in the queue
+            print(f"Received signal: {signal}")  # Print the signal to the terminal
     except KeyboardInterrupt:
         print("Stopping listener...")
         listener.stop_listening()  # Stop the listener gracefully
@@ -0,0 +1,138 @@
+import time
+import numpy as np
+from PIL import Image
+
+# steps in the order they run; any of them can be left out
+STEPS = ("grayscale", "crop", "downscale", "deskew", "threshold")
+
+
+def to_grayscale(image: Image) -> np.ndarray:
+    # transparent pixels count as white paper
+    if image.mode in ("RGBA", "LA", "PA") or (image.mode == "P" and "transparency" in image.info):
+        background = Image.new("RGBA", image.size, "white")
+        image = Image.alpha_composite(background, image.convert("RGBA"))
+    return np.asarray(image.convert("L"))
+
+
+def otsu_threshold(gray: np.ndarray) -> int:
+    # grey level that best separates ink (<= threshold) from paper
+    histogram = np.bincount(gray.ravel(), minlength=256).astype(np.float64)
+    levels = np.arange(256)
+    weight = np.cumsum(histogram)
+    total = weight[-1]
+    mean = np.cumsum(histogram * levels)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        between = (mean[-1] * weight - mean * total) ** 2 / (weight * (total - weight))
+    if np.isnan(between).all():
+        return int(gray.min()) - 1  # a single grey level, all paper
+    return int(np.nanargmax(between))
+
+
+def find_page(gray: np.ndarray, min_area: float = 0.25) -> tuple[int, int, int, int] | None:
+    # bounding box of the bright paper in front of a darker background, None if no such box is found
+    step = max(1, max(gray.shape) // 400)
+    small = gray[::step, ::step]
+    paper = small > otsu_threshold(small)
+    rows = np.flatnonzero(paper.mean(axis=1) > 0.5)
+    cols = np.flatnonzero(paper.mean(axis=0) > 0.5)
+    if not rows.size or not cols.size:
+        return None
+    box = (cols[0] * step, rows[0] * step, min(gray.shape[1], (cols[-1] + 1) * step),
+           min(gray.shape[0], (rows[-1] + 1) * step))
+    if (box[2] - box[0]) * (box[3] - box[1]) < min_area * gray.size:
+        return None
+    return box
+
+
+def downscale(gray: np.ndarray, target_dpi: int, page_width_in: float) -> np.ndarray:
+    # shrinks to target_dpi assuming the page spans the full width; never enlarges
+    scale = target_dpi * page_width_in / gray.shape[1]
+    if scale >= 1:
+        return gray
+    size = (max(1, round(gray.shape[1] * scale)), max(1, round(gray.shape[0] * scale)))
+    return np.asarray(Image.fromarray(gray).resize(size, Image.Resampling.BOX))
+
+
+def skew_angle(gray: np.ndarray, max_angle: float = 5.0, step: float = 0.5) -> float:
+    # angle in degrees (counter clockwise) that lines the text rows up horizontally, by the projection profile
+    scale = max(1, gray.shape[1] // 600)
+    ink = Image.fromarray(((gray[::scale, ::scale] <= otsu_threshold(gray)) * 255).astype(np.uint8))
+
+    def score(angle: float) -> float:
+        # sharp changes between rows means rows of text and gaps between them are cleanly separated
+        profile = np.asarray(ink.rotate(angle, Image.Resampling.NEAREST), dtype=np.int64).sum(axis=1)
+        return float(np.square(np.diff(profile)).sum())
+
+    # an angle has to do strictly better than leaving the page as it is
+    best_angle, best_score = 0.0, score(0.0)
+    for angle in np.arange(-max_angle, max_angle + step / 2, step):
+        angle_score = score(float(angle))
+        if angle_score > best_score:
+            best_angle, best_score = float(angle), angle_score
+    return best_angle
+
+
+def deskew(gray: np.ndarray, max_angle: float = 5.0, step: float = 0.5) -> np.ndarray:
+    angle = skew_angle(gray, max_angle, step)
+    if angle == 0:
+        return gray
+    return np.asarray(Image.fromarray(gray).rotate(angle, Image.Resampling.BICUBIC, fillcolor=255))
+
+
+def _box_sums(values: np.ndarray, radius: int, axis: int) -> tuple[np.ndarray, np.ndarray]:
+    # sums over a window of radius around each position along axis, and the window sizes
+    length = values.shape[axis]
+    sums = np.cumsum(values, axis=axis, dtype=np.int32)
+    sums = np.concatenate([np.zeros_like(sums.take([0], axis=axis)), sums], axis=axis)
+    positions = np.arange(length)
+    start = np.clip(positions - radius, 0, length)
+    end = np.clip(positions + radius + 1, 0, length)
+    return sums.take(end, axis=axis) - sums.take(start, axis=axis), end - start
+
+
+def adaptive_threshold(gray: np.ndarray, block: int = 31, offset: int = 10) -> np.ndarray:
+    # a pixel is ink if it is more than offset darker than the mean of the block around it, so uneven
+    # lighting across a photographed page does not turn whole areas black or white
+    radius = block // 2
+    rows, heights = _box_sums(gray, radius, 1)
+    sums, widths = _box_sums(rows, radius, 0)
+    counts = widths[:, None] * heights[None, :]
+    ink = gray.astype(np.int32) * counts < sums - offset * counts
+    return np.where(ink, 0, 255).astype(np.uint8)
+
+
+def preprocess(image: Image, steps: tuple[str, ...] = STEPS, target_dpi: int = 300, page_width_in: float = 8.5
+               ) -> tuple[Image, dict[str, float]]:
+    """
+    Prepares a camera frame for tesseract: grayscale, crop to the page, downscale to target_dpi for a page
+    page_width_in inches wide, deskew, then adaptive threshold. Returns the image and the seconds each step took.
+    Every step but grayscale works on the grayscale image, so leaving grayscale out only skips the others too.
+    """
+    timings: dict[str, float] = {}
+    if "grayscale" not in steps:
+        return image, timings
+    last = time.perf_counter()
+
+    def mark(step: str) -> None:
+        nonlocal last
+        now = time.perf_counter()
+        timings[step] = now - last
+        last = now
+
+    gray = to_grayscale(image)
+    mark("grayscale")
+    if "crop" in steps:
+        box = find_page(gray)
+        if box is not None:
+            gray = gray[box[1]:box[3], box[0]:box[2]]
+        mark("crop")
+    if "downscale" in steps:
+        gray = downscale(gray, target_dpi, page_width_in)
+        mark("downscale")
+    if "deskew" in steps:
+        gray = deskew(gray)
+        mark("deskew")
+    if "threshold" in steps:
+        gray = adaptive_threshold(gray)
+        mark("threshold")
+    return Image.fromarray(gray), timings
@@ -0,0 +1,110 @@
+import os
+import re
+import sqlite3
+import threading
+
+from textfile import TextFile
+
+# rowids are doc_id << SENTENCE_BITS | sentence number, so a document's rows are one rowid range
+SENTENCE_BITS = 32
+
+
+class SearchResult:
+    def __init__(self, doc_id: int, sentence: int, position: int, snippet: str) -> None:
+        self.doc_id = doc_id
+        self.sentence = sentence  # line number in the document's text.txt
+        self.position = position  # text offset of the sentence, see Document(position=...)
+        self.snippet = snippet
+
+    def __repr__(self) -> str:
+        return f'SearchResult({self.doc_id}, {self.sentence}, {self.snippet!r})'
+
+
+class SearchIndex:
+    """
+    Inverted index over the sentences of every document in the library, an SQLite FTS5 table in
+    <directory>/search.db, so a query looks up its tokens instead of scanning every text.txt.
+    Documents are indexed one at a time as they are added; update() catches up with the library.
+    Bare words match as prefixes, words in double quotes as a phrase, and all of them have to match.
+    """
+    def __init__(self, directory: str = 'library') -> None:
+        os.makedirs(directory, exist_ok=True)
+        # indexing runs on a background thread while the reader may search, so the connection is shared under a lock
+        self.db = sqlite3.connect(os.path.join(directory, 'search.db'), check_same_thread=False)
+        self.lock = threading.Lock()
+        with self.lock, self.db:
+            self.db.execute('PRAGMA journal_mode=WAL')
+            # prefix indexes make short prefixes as fast as whole tokens
+            self.db.execute('''CREATE VIRTUAL TABLE IF NOT EXISTS sentences USING fts5(
+                text, position UNINDEXED, tokenize = 'unicode61 remove_diacritics 2', prefix = '2 3')''')
+            self.db.execute('''CREATE TABLE IF NOT EXISTS indexed (
+                doc_id INTEGER PRIMARY KEY,
+                text_bytes INTEGER NOT NULL  -- size of text.txt when indexed, a different size means reindex
+            )''')
+
+    def add_document(self, doc_id: int, path: str) -> None:
+        # (re)indexes the sentences of one document's text.txt
+        try:
+            text = TextFile(path)
+        except OSError as e:
+            print(f"Error indexing document {doc_id}: {e}")
+            return
+        text_bytes = text.size
+        rows = (((doc_id << SENTENCE_BITS) | num, text.sentence(num), text.start(num)) for num in range(text.count))
+        with self.lock, self.db:
+            self._delete(doc_id)
+            self.db.executemany('INSERT INTO sentences (rowid, text, position) VALUES (?, ?, ?)', rows)
+            self.db.execute('INSERT OR REPLACE INTO indexed (doc_id, text_bytes) VALUES (?, ?)', (doc_id, text_bytes))
+
+    def remove_document(self, doc_id: int) -> None:
+        with self.lock, self.db:
+            self._delete(doc_id)
+
+    def _delete(self, doc_id: int) -> None:
+        self.db.execute('DELETE FROM sentences WHERE rowid BETWEEN ? AND ?',
+                        (doc_id << SENTENCE_BITS, ((doc_id + 1) << SENTENCE_BITS) - 1))
+        self.db.execute('DELETE FROM indexed WHERE doc_id = ?', (doc_id,))
+
+    def update(self, documents: list[tuple[int, str]]) -> int:
+        # indexes the (doc_id, text path) documents that are new or changed and drops ones no longer listed,
+        # returns how many were indexed
+        with self.lock:
+            indexed = dict(self.db.execute('SELECT doc_id, text_bytes FROM indexed').fetchall())
+        count = 0
+        for doc_id, path in documents:
+            if os.path.exists(path) and indexed.get(doc_id) != os.path.getsize(path):
+                self.add_document(doc_id, path)
+                count += 1
+        for doc_id in set(indexed) - {doc_id for doc_id, _ in documents}:
+            self.remove_document(doc_id)
+        return count
+
+    @staticmethod
+    def match_expression(query: str) -> str:
+        # FTS5 query for the user's text: "quoted words" are a phrase, any other word a prefix
+        terms = []
+        for phrase, word in re.findall(r'"([^"]*)"?|(\S+)', query):
+            if phrase.strip():
+                terms.append('"' + phrase.replace('"', '""') + '"')
+            elif word:
+                terms.append('"' + word.replace('"', '""') + '"*')
+        return ' AND '.join(terms)
+
+    def search(self, query: str, limit: int = 50) -> list[SearchResult]:
+        # matches in library order, first document first and in reading order within each
+        expression = self.match_expression(query)
+        if not expression:
+            return []
+        with self.lock:
+            try:
+                rows = self.db.execute('''SELECT rowid, position, snippet(sentences, 0, '', '', '...', 8)
+                                          FROM sentences WHERE sentences MATCH ? ORDER BY rowid LIMIT ?''',
+                                       (expression, limit)).fetchall()
+            except sqlite3.OperationalError as e:
+                print(f"Error searching for {query!r}: {e}")
+                return []
+        return [SearchResult(rowid >> SENTENCE_BITS, rowid & ((1 << SENTENCE_BITS) - 1), position, snippet)
+                for rowid, position, snippet in rows]
+
+    def close(self) -> None:
+        self.db.close()
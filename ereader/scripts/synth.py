@@ -0,0 +1,104 @@
+import itertools
+import queue
+import subprocess
+import threading
+from typing import Callable
+
+# job priorities, lower runs first
+PLAYING = 0
+LOOKAHEAD = 1
+BACKGROUND = 2
+
+
+class SynthJob:
+    def __init__(self, group: str, text: str, path: str, lang: str = 'en-US',
+                 on_done: Callable[['SynthJob'], None] | None = None) -> None:
+        self.group = group  # jobs are cancelled by group, e.g. all sentences of a page
+        self.text = text
+        self.path = path
+        self.lang = lang
+        self.on_done = on_done  # called from the worker after a successful synthesis
+        self.priority = BACKGROUND
+        self.done = threading.Event()
+        self.cancelled = False
+        self.started = False
+        self.returncode: int | None = None
+        self.failed = False  # pico2wave could not be run, or finishing the job raised
+        self.proc: subprocess.Popen | None = None
+
+    def wait(self, timeout: float | None = None) -> bool:
+        # True once the job is over: the wav file is written, or synthesis failed or was cancelled
+        return self.done.wait(timeout)
+
+    def succeeded(self) -> bool:
+        return self.done.is_set() and not self.failed and self.returncode == 0
+
+
+class SynthScheduler:
+    """
+    Runs pico2wave jobs on a fixed number of worker threads, most urgent first.
+    Jobs start as background work in submission order; prioritize moves the sentence about to
+    play and the ones after it to the front. Jobs for pages the reader has left can be cancelled.
+    """
+    def __init__(self, workers: int = 2) -> None:
+        self.queue = queue.PriorityQueue()
+        self.order = itertools.count()  # keeps submission order within a priority
+        self.lock = threading.Lock()
+        self.jobs: list[SynthJob] = []
+        self.workers = [threading.Thread(target=self._work, daemon=True) for _ in range(workers)]
+        for worker in self.workers:
+            worker.start()
+
+    def submit(self, group: str, text: str, path: str, lang: str = 'en-US',
+               on_done: Callable[[SynthJob], None] | None = None) -> SynthJob:
+        job = SynthJob(group, text, path, lang, on_done)
+        with self.lock:
+            self.jobs.append(job)
+        self.queue.put((job.priority, next(self.order), job))
+        return job
+
+    def prioritize(self, jobs: list[SynthJob]) -> None:
+        # the first job is needed now, the rest are the lookahead window in playing order
+        for i, job in enumerate(jobs):
+            priority = PLAYING if i == 0 else LOOKAHEAD
+            if job.started or job.cancelled or priority >= job.priority:
+                continue
+            # queue entries cannot be updated, so queue the job again and skip the stale entry later
+            job.priority = priority
+            self.queue.put((priority, next(self.order), job))
+
+    def cancel(self, group: str | None = None) -> None:
+        # cancels all jobs of group, or every job if group is None
+        with self.lock:
+            cancelled = [job for job in self.jobs if group is None or job.group == group]
+            self.jobs = [job for job in self.jobs if group is not None and job.group != group]
+            for job in cancelled:
+                job.cancelled = True
+                if job.proc is not None and job.proc.poll() is None:
+                    job.proc.terminate()
+                job.done.set()
+
+    def _work(self) -> None:
+        while True:
+            priority, _, job = self.queue.get()
+            with self.lock:
+                if job.started or job.cancelled or priority != job.priority:
+                    continue
+                job.started = True
+            # whatever goes wrong, the job is finished and the worker stays alive for the next one
+            try:
+                with self.lock:
+                    if not job.cancelled:
+                        job.proc = subprocess.Popen(['pico2wave', f'-l={job.lang}', f'-w={job.path}', job.text])
+                if job.proc is not None:
+                    job.returncode = job.proc.wait()
+                if job.returncode == 0 and not job.cancelled and job.on_done is not None:
+                    job.on_done(job)
+            except Exception as e:
+                print(f"Error synthesizing {job.path}: {e}")
+                job.failed = True
+            finally:
+                with self.lock:
+                    if job in self.jobs:
+                        self.jobs.remove(job)
+                job.done.set()
@@ -0,0 +1,116 @@
+from array import array
+import bisect
+import hashlib
+import mmap
+import os
+import struct
+
+# magic, version, text size, text mtime_ns, sentence count, sha1 of the text
+HEADER = struct.Struct('<4sHQqI20s')
+VERSION = 1
+
+
+class TextFile:
+    """
+    A document's text.txt, one sentence per line, memory mapped so only the parts being laid out,
+    shown or spoken are read and decoded. Offsets are character offsets in the sentences joined by
+    single newlines, like the page layouts use; the sentence start offsets (in bytes and in characters)
+    are kept in arrays, built once and cached next to the text in <name>.idx.
+    """
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.index_path = os.path.splitext(path)[0] + '.idx'
+        with open(path, 'rb') as file:
+            stat = os.fstat(file.fileno())
+            # an empty file cannot be mapped, but there is nothing to read from it either
+            self.data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) if stat.st_size else b''
+        self.size = stat.st_size
+        self.mtime = stat.st_mtime_ns
+        # entry i is where sentence i starts, and entry count where the sentence after the last would
+        self.byte_starts = array('I')
+        self.char_starts = array('I')
+        self.hash = ''
+        if not self._load_index():
+            self._build_index()
+            self._save_index()
+        self.count = len(self.char_starts) - 1
+        self.total_chars = self.char_starts[-1]
+
+    def _load_index(self) -> bool:
+        try:
+            with open(self.index_path, 'rb') as file:
+                magic, version, size, mtime, count, digest = HEADER.unpack(file.read(HEADER.size))
+                if magic != b'SENT' or version != VERSION or size != self.size or mtime != self.mtime:
+                    return False
+                self.byte_starts.fromfile(file, count + 1)
+                self.char_starts.fromfile(file, count + 1)
+        except (OSError, struct.error, EOFError):
+            self.byte_starts = array('I')
+            self.char_starts = array('I')
+            return False
+        self.hash = digest.hex()
+        return True
+
+    def _build_index(self) -> None:
+        # one pass over the text, decoding a line at a time to count its characters
+        data = self.data
+        byte_start = char_start = 0
+        while byte_start < self.size:
+            end = data.find(b'\n', byte_start)
+            if end < 0:
+                end = self.size
+            self.byte_starts.append(byte_start)
+            self.char_starts.append(char_start)
+            char_start += len(self._decode(byte_start, end)) + 1
+            byte_start = end + 1
+        self.byte_starts.append(byte_start)
+        self.char_starts.append(char_start)
+        self.hash = hashlib.sha1(data).hexdigest()
+
+    def _save_index(self) -> None:
+        # written to a temporary file first, so a crash never leaves a truncated index behind
+        tmp_path = self.index_path + '.tmp'
+        try:
+            with open(tmp_path, 'wb') as file:
+                file.write(HEADER.pack(b'SENT', VERSION, self.size, self.mtime, len(self.char_starts) - 1,
+                                       bytes.fromhex(self.hash)))
+                self.byte_starts.tofile(file)
+                self.char_starts.tofile(file)
+            os.replace(tmp_path, self.index_path)
+        except OSError as e:
+            print(f"Error saving sentence index {self.index_path}: {e}")
+
+    def _decode(self, start: int, end: int) -> str:
+        line = self.data[start:end]
+        if line.endswith(b'\r'):
+            line = line[:-1]
+        return line.decode('utf-8', errors='replace')
+
+    def sentence(self, num: int) -> str:
+        return self._decode(self.byte_starts[num], self.byte_starts[num + 1] - 1)
+
+    def start(self, num: int) -> int:
+        # offset of sentence num, the length of the text plus one for num == count
+        return self.char_starts[num]
+
+    def end(self, num: int) -> int:
+        # offset just past the last character of sentence num
+        return self.char_starts[num + 1] - 1
+
+    def sentence_at(self, offset: int) -> int:
+        # number of the sentence containing offset (or the newline after it)
+        return min(bisect.bisect_right(self.char_starts, offset) - 1, self.count - 1)
+
+    def __getitem__(self, key: slice) -> str:
+        # text[start:end] decodes just the sentences the span touches; newlines between them are kept
+        start = key.start or 0
+        end = self.total_chars - 1 if key.stop is None else min(key.stop, self.total_chars - 1)
+        if start >= end:
+            return ''
+        # the sentence at end too, in case the span ends with the newline after end - 1's sentence
+        first, last = self.sentence_at(start), self.sentence_at(end)
+        text = '\n'.join(self.sentence(num) for num in range(first, last + 1))
+        return text[start - self.char_starts[first]:end - self.char_starts[first]]
+
+    def __repr__(self) -> str:
+        return f'TextFile({self.path!r})'
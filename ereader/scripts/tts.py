@@ -1,39 +1,113 @@
-import subprocess
 import shutil
 import os
 from collections import defaultdict
+from typing import Callable
+
+from audiocache import AudioCache
+from audiosink import AplaySink, AudioOutput, AudioSink, read_wav
+from synth import SynthJob, SynthScheduler
+
+# seconds the audio thread waits for a sentence's synthesis before skipping it
+SYNTH_TIMEOUT = 30
 
 
 class TTSPlayer:
-    def __init__(self, tts_dir: str) -> None:
-        self.tts_dir = tts_dir
-        self.tts_procs: defaultdict[str, list[subprocess.Popen]] = defaultdict(list)
+    def __init__(self, tts_dir: str, cache_dir: str = 'cache/tts', workers: int = 2, lookahead: int = 3,
+                 lang: str = 'en-US', compress_cache: bool = False, sink: AudioSink | None = None,
+                 on_sentence: Callable[[tuple[str, int]], None] | None = None,
+                 on_finished: Callable[[], None] | None = None,
+                 on_synthesized: Callable[[str], None] | None = None) -> None:
+        self.tts_dir = tts_dir  # scratch files, removed when a page or the reader is left
+        self.cache = AudioCache(cache_dir, compress=compress_cache)
+        self.voice = {"engine": "pico2wave", "lang": lang}
+        self.synth = SynthScheduler(workers)
+        self.lookahead = lookahead  # sentences after the playing one that are synthesized next
+        self.tts_keys: defaultdict[str, list[str]] = defaultdict(list)  # audio cache key of each sentence
+        self.tts_jobs: defaultdict[str, list[SynthJob | None]] = defaultdict(list)  # None if already cached
+        self.pending: dict[str, SynthJob] = {}  # running or queued synthesis by cache key
         self.playing_sent: dict[str, int] = {}
-        self.audio_proc: subprocess.Popen = None
-        self.volume: int = None
-        self.init_volume()
+        self.now_playing: tuple[str, int] | None = None
+        # volume is applied to the samples, 100 leaves them as synthesized
+        self.volume = 100
+        # called from the audio and synthesis threads, e.g. to post events to the app's event loop
+        self.on_sentence = on_sentence  # with (dirname, sentence number) when a sentence starts to be heard
+        self.on_synthesized = on_synthesized  # with the cache key of each sentence synthesized
+        self.output = AudioOutput(sink if sink is not None else AplaySink(), self._on_start, on_finished)
+
+    def _store(self, key: str, job: SynthJob) -> None:
+        self.cache.store(key, job.path)
+        self.pending.pop(key, None)
+        if self.on_synthesized is not None:
+            self.on_synthesized(key)
 
     def add_sentences(self, dirname: str, sentences: list[str]) -> None:
         os.makedirs(os.path.join(self.tts_dir, dirname), exist_ok=True)
         for i, sent in enumerate(sentences, 1):
-            self.tts_procs[dirname].append(
-                subprocess.Popen(['pico2wave', f'-w={self.tts_dir}/{dirname}/sent{i}.wav', sent]))
+            key = AudioCache.key(sent, self.voice)
+            job = None
+            if key not in self.cache:
+                job = self.pending.get(key)
+                if job is None or job.cancelled or (job.done.is_set() and not job.succeeded()):
+                    # nothing running for it, or it failed before (e.g. pico2wave was missing), so try again
+                    job = self.synth.submit(dirname, sent, f'{self.tts_dir}/{dirname}/sent{i}.wav', self.voice["lang"],
+                                            lambda job, key=key: self._store(key, job))
+                    self.pending[key] = job
+            self.tts_keys[dirname].append(key)
+            self.tts_jobs[dirname].append(job)
         self.playing_sent[dirname] = 0
 
+    def _load(self, dirname: str, num: int, key: str, job: SynthJob | None):
+        # runs on the audio output thread when the sentence's turn comes
+        if job is not None and not job.wait(SYNTH_TIMEOUT):
+            print(f"Gave up waiting for sentence {num} of {dirname}")
+            return None
+        if job is not None and not job.cancelled and not job.succeeded():
+            print(f"Synthesis of sentence {num} of {dirname} failed")
+            return None
+        path = self.cache.lookup(key, f'{self.tts_dir}/{dirname}/sent{num}.wav')
+        if path is None:
+            print(f"No audio for sentence {num} of {dirname}")
+            return None
+        return read_wav(path)
+
+    def _on_start(self, tag: tuple[str, int]) -> None:
+        dirname, num = tag
+        if dirname in self.playing_sent:
+            self.playing_sent[dirname] = num
+        self.now_playing = tag
+        if self.on_sentence is not None:
+            self.on_sentence(tag)
+
+    def queue_sentences(self, dirname: str, start: int = 1) -> None:
+        # appends sentences start.. of dirname behind whatever is already queued, so they follow without a gap
+        for num in range(start, len(self.tts_keys[dirname]) + 1):
+            job = self.tts_jobs[dirname][num - 1]
+            key = self.tts_keys[dirname][num - 1]
+            if job is not None and job.cancelled:
+                # the job was shared with a page that has been left since
+                job = self.synth.submit(dirname, job.text, f'{self.tts_dir}/{dirname}/sent{num}.wav',
+                                        self.voice["lang"], lambda job, key=key: self._store(key, job))
+                self.pending[key] = self.tts_jobs[dirname][num - 1] = job
+            self.output.enqueue((dirname, num), lambda dirname=dirname, num=num, key=key, job=job:
+                                self._load(dirname, num, key, job))
+
     def play_sentence(self, dirname: str, num: int) -> bool:
-        if num < 1 or num > len(self.tts_procs[dirname]):
+        # plays from sentence num to the end of dirname, replacing anything playing or queued
+        if num < 1 or num > len(self.tts_keys[dirname]):
             return False
-        if self.audio_proc is not None:
-            self.audio_proc.terminate()
-            self.audio_proc.stdin.close()
-        self.tts_procs[dirname][num - 1].wait()
+        self.output.flush()
+        self.now_playing = None
+        self.synth.prioritize([job for job in self.tts_jobs[dirname][num - 1:num + self.lookahead] if job is not None])
         self.playing_sent[dirname] = num
-        self.audio_proc = subprocess.Popen(['aplay', '-i', f'{self.tts_dir}/{dirname}/sent{num}.wav'], stdin=subprocess.PIPE,
-                                           text=True)
+        self.queue_sentences(dirname, num)
         return True
 
+    def playing(self) -> tuple[str, int] | None:
+        # (dirname, sentence number) of the sentence being heard, None when nothing is
+        return self.now_playing if self.output.is_busy() else None
+
     def play_next(self, dirname: str) -> bool:
-        if self.playing_sent[dirname] == len(self.tts_procs[dirname]):
+        if self.playing_sent[dirname] == len(self.tts_keys[dirname]):
             return False
         self.playing_sent[dirname] += 1
         return self.play_sentence(dirname, self.playing_sent[dirname])
@@ -45,67 +119,42 @@ class TTSPlayer:
         return self.play_sentence(dirname, self.playing_sent[dirname])
 
     def stop(self) -> None:
-        self.audio_proc.kill()
+        self.output.flush()
+        self.now_playing = None
 
-    # does not work currently
     def pause_resume(self) -> None:
-        if self.audio_proc is not None:
-            self.audio_proc.stdin.write('\n')
-            self.audio_proc.stdin.flush()
+        self.output.set_paused(not self.output.paused)
 
     def is_playing(self) -> bool:
-        return self.audio_proc is not None and self.audio_proc.poll() is None
+        return self.output.is_busy()
 
     def remove(self, dirname: str) -> None:
+        self.synth.cancel(dirname)
+        self.pending = {key: job for key, job in self.pending.items() if not job.cancelled}
         path = os.path.join(self.tts_dir, dirname)
         if os.path.exists(path):
             shutil.rmtree(path)
-        self.tts_procs.pop(dirname)
+        self.tts_keys.pop(dirname)
+        self.tts_jobs.pop(dirname)
         self.playing_sent.pop(dirname)
 
     def clean(self) -> None:
+        self.output.flush()
+        self.now_playing = None
+        self.synth.cancel()
         try:
             shutil.rmtree(self.tts_dir)
         except FileNotFoundError:
             pass
-        self.tts_procs = defaultdict(list)
+        self.tts_keys = defaultdict(list)
+        self.tts_jobs = defaultdict(list)
+        self.pending = {}
         self.playing_sent = {}
-        self.audio_proc = None
-        
-    def init_volume(self) -> None:
-        try:
-            process = subprocess.Popen(["amixer", "sget", "Master"], stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
-            output, error = process.communicate()
-
-            if process.returncode != 0:
-                print(f"Error exectuting amixer: {error.strip()}")
-                self.volume = 0
-                return
-            
-            for line in output.splitlines():
-                if "%" in line:
-                    volume_str = line.split("[")[2].split("%")[0]
-                    self.volume = int(volume_str)
-                    return
-        except (IndexError, ValueError) as e:
-            print(f"Error retrieving volume: {e}")
-        finally:
-            self.volume = 0
-            return
 
     def volume_up(self, value: int=10) -> None:
         self.volume = min(100, self.volume + value)
-        try:
-            command = ["amixer", "sset", "Master", f"{self.volume}%"]
-            subprocess.run(command)
-        except Exception as e:
-            print(f"Error increasing volume: {e}")
+        self.output.gain = self.volume / 100
 
     def volume_down(self, value: int=10) -> None:
         self.volume = max(0, self.volume - value)
-        try:
-            command = ["amixer", "sset", "Master", f"{self.volume}%"]
-            subprocess.run(command)
-        except Exception as e:
-            print(f"Error increasing volume: {e}")
-
+        self.output.gain = self.volume / 100
@@ -11,38 +11,89 @@ BACK_PIN = 4
 UP_PIN = 8
 DOWN_PIN = 16
 
-# Define pins with pull-up resistors
-select = machine.Pin(SELECT_PIN, machine.Pin.IN, machine.Pin.PULL_UP)
-back = machine.Pin(BACK_PIN, machine.Pin.IN, machine.Pin.PULL_UP)
-up = machine.Pin(UP_PIN, machine.Pin.IN, machine.Pin.PULL_UP)
-down = machine.Pin(DOWN_PIN, machine.Pin.IN, machine.Pin.PULL_UP)
-
-# Global variable for debouncing
-last_triggered = 0
-
-def closure(value):
-    # Function to handle pin interrupts
-    def pin_triggered(pin):
-        try:
-            global last_triggered
-            current_time = utime.ticks_ms()
-            if utime.ticks_diff(current_time, last_triggered) < 50:  # Debounce for 50ms
-                return
-            last_triggered = current_time
-            sys.stdout.buffer.write(str(value).encode('utf-8') + b'\n')
-            led.toggle()
-        except Exception as e:
-            sys.stderr.write(f"Error in interrupt handler: {e}\n")
-
-# Attach interrupts to pins
-select.irq(trigger=machine.Pin.IRQ_RISING, handler=closure(1))
-back.irq(trigger=machine.Pin.IRQ_RISING, handler=closure(2))
-up.irq(trigger=machine.Pin.IRQ_RISING, handler=closure(3))
-down.irq(trigger=machine.Pin.IRQ_RISING, handler=closure(4))
+# Timings in ms
+DEBOUNCE_MS = 30  # a button's level has to stay this long before a change counts
+HOLD_MS = 600  # held this long after the press sends a hold
+REPEAT_MS = 150  # then a repeat this often until it is released
+TICK_MS = 10  # how often held buttons are checked
+
+# Events go to the host one per line as "<seq> <ticks_ms> <button> <kind>", kind p (press), h (hold) or
+# r (repeat). seq counts up mod 2**16 from 0 at boot, so the host can tell lost and repeated lines apart
+SEQ_MODULO = 1 << 16
+seq = 0
+
+
+def send(button, kind):
+    global seq
+    try:
+        sys.stdout.buffer.write(f"{seq} {utime.ticks_ms()} {button} {kind}\n".encode('utf-8'))
+    except Exception as e:
+        sys.stderr.write(f"Error sending event: {e}\n")
+    seq = (seq + 1) % SEQ_MODULO
+
+
+class Button:
+    def __init__(self, number, pin_number):
+        self.number = number
+        # pull-up, so the pin reads 0 while the button is pressed
+        self.pin = machine.Pin(pin_number, machine.Pin.IN, machine.Pin.PULL_UP)
+        self.pressed = False
+        self.last_change = utime.ticks_ms()  # when the pin last changed level, for debouncing
+        self.level_pressed = False
+        self.next_event = 0  # ticks_ms when the next hold or repeat is due while pressed
+        self.held = False
+        self.pin.irq(trigger=machine.Pin.IRQ_FALLING | machine.Pin.IRQ_RISING, handler=self.closure())
+
+    def closure(self):
+        # Function to handle pin interrupts
+        def pin_triggered(pin):
+            try:
+                self.level_pressed = pin.value() == 0
+                self.last_change = utime.ticks_ms()
+            except Exception as e:
+                sys.stderr.write(f"Error in interrupt handler: {e}\n")
+        return pin_triggered
+
+    def update(self, now):
+        # a change counts once the pin has kept its new level for DEBOUNCE_MS, each button on its own
+        level_pressed = self.pin.value() == 0
+        if level_pressed != self.level_pressed:
+            # an edge the interrupt has not recorded (yet)
+            self.level_pressed = level_pressed
+            self.last_change = now
+        if self.level_pressed != self.pressed and utime.ticks_diff(now, self.last_change) >= DEBOUNCE_MS:
+            self.pressed = self.level_pressed
+            if self.pressed:
+                send(self.number, "p")
+                led.toggle()
+                self.held = False
+                self.next_event = utime.ticks_add(now, HOLD_MS)
+            return
+        if self.pressed and utime.ticks_diff(now, self.next_event) >= 0:
+            send(self.number, "r" if self.held else "h")
+            self.held = True
+            self.next_event = utime.ticks_add(now, REPEAT_MS)
+
+
+buttons = [Button(1, SELECT_PIN), Button(2, BACK_PIN), Button(3, UP_PIN), Button(4, DOWN_PIN)]
+
+
+def tick(timer):
+    try:
+        now = utime.ticks_ms()
+        for button in buttons:
+            button.update(now)
+    except Exception as e:
+        sys.stderr.write(f"Error in button timer: {e}\n")
+
+
+# Debounce, hold and repeat timing all run from one periodic timer, edges only restart the debounce time
+timer = machine.Timer(period=TICK_MS, mode=machine.Timer.PERIODIC, callback=tick)
 
 # Keep the program running
 try:
     while True:
         utime.sleep(1)
 except KeyboardInterrupt:
+    timer.deinit()
     print("Program terminated.")